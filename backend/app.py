@@ -1,17 +1,39 @@
 """
 保险经纪人业绩分析系统 - Flask API
 """
+import io
 import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
 from flask import Flask, request, jsonify, send_from_directory, abort
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from services.excel_parser import ExcelParser
 from services.data_store import DataStore
 from services.data_matcher import DataMatcher
 from services.kpi_calculator import KPICalculator
 
+class ORJSONProvider(DefaultJSONProvider):
+    """基于orjson的JSON序列化：C实现，原生支持numpy/datetime"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
 CORS(app, resources={
     r"/api/*": {
         "origins": ["https://insurance-84s7jxnv7-tonys-projects-a2818332.vercel.app"],
@@ -29,11 +51,60 @@ ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # 初始化服务
-data_store = DataStore(os.path.join(os.path.dirname(__file__), '..', 'data', 'analytics.db'))
+DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'analytics.db')
+data_store = DataStore(DB_PATH)
 excel_parser = ExcelParser()
 data_matcher = DataMatcher()
 kpi_calculator = KPICalculator(data_store)
 
+# 上传处理进程池：解析+匹配是CPU密集型，放到子进程避免阻塞请求线程
+# 任务状态记在数据库的upload_jobs表里，多工作进程部署下
+# 轮询请求不一定落在接收上传的那个进程上
+upload_executor = ProcessPoolExecutor(max_workers=2)
+
+# 按数据版本缓存只读端点的响应，数据写入后自动失效
+_response_cache = {}
+
+
+def _cached_by_data_version(key, producer):
+    """数据版本未变时复用上次的计算结果"""
+    version = data_store.data_version
+    cached = _response_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    value = producer()
+    _response_cache[key] = (version, value)
+    return value
+
+
+def _process_upload(payload: bytes, filepath: str, db_path: str, job_id: str):
+    """在子进程中执行解析、匹配和入库，结果写回任务表供查询"""
+    store = DataStore(db_path)
+    try:
+        parser = ExcelParser()
+        matcher = DataMatcher()
+
+        # 直接从内存解析，解析成功后才落盘存档，避免坏文件的无谓写入
+        parsed_data = parser.parse(io.BytesIO(payload))
+        with open(filepath, 'wb') as f:
+            f.write(payload)
+
+        # 模糊匹配社保数据
+        if parsed_data.get('social_security') and parsed_data.get('agents'):
+            parsed_data['social_security'] = matcher.match_social_security(
+                parsed_data['social_security'],
+                parsed_data['agents']
+            )
+
+        result = store.save_data(parsed_data)
+    except Exception as e:
+        store.finish_upload_job(job_id, error=str(e))
+        raise
+
+    store.finish_upload_job(job_id, result=result)
+    return result
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -61,36 +132,54 @@ def upload_file():
     try:
         filename = secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # 上传内容直接进内存（受MAX_CONTENT_LENGTH约束），不预先落盘
+        payload = file.read()
+
+        # 登记任务后提交后台处理，立即返回job_id供前端轮询
+        job_id = uuid.uuid4().hex
+        data_store.create_upload_job(job_id)
+        upload_executor.submit(
+            _process_upload, payload, filepath, DB_PATH, job_id
+        )
 
-        # 解析Excel
-        parsed_data = excel_parser.parse(filepath)
+        return jsonify({
+            'success': True,
+            'message': '文件已接收，正在后台处理',
+            'job_id': job_id
+        }), 202
+    except Exception as e:
+        return jsonify({'error': f'处理文件时出错: {str(e)}'}), 500
 
-        # 模糊匹配社保数据
-        if parsed_data.get('social_security') and parsed_data.get('agents'):
-            matched_ss = data_matcher.match_social_security(
-                parsed_data['social_security'],
-                parsed_data['agents']
-            )
-            parsed_data['social_security'] = matched_ss
 
-        # 存储数据
-        result = data_store.save_data(parsed_data)
+@app.route('/api/upload-status/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    """查询上传任务的处理状态"""
+    job = data_store.pop_upload_job(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+
+    if job['status'] == 'processing':
+        return jsonify({'status': 'processing'})
 
+    if job['status'] == 'error':
         return jsonify({
-            'success': True,
-            'message': '文件上传并处理成功',
-            'summary': result
+            'status': 'error',
+            'error': f"处理文件时出错: {job['error']}"
         })
-    except Exception as e:
-        return jsonify({'error': f'处理文件时出错: {str(e)}'}), 500
+
+    return jsonify({
+        'status': 'done',
+        'success': True,
+        'message': '文件上传并处理成功',
+        'summary': job['result']
+    })
 
 
 @app.route('/api/filters', methods=['GET'])
 def get_filter_options():
     """获取筛选器选项"""
     try:
-        options = data_store.get_filter_options()
+        options = _cached_by_data_version('filters', data_store.get_filter_options)
         return jsonify(options)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -223,7 +312,7 @@ def download_file(filename):
 def get_summary():
     """获取数据概览"""
     try:
-        summary = data_store.get_data_summary()
+        summary = _cached_by_data_version('summary', data_store.get_data_summary)
         return jsonify(summary)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
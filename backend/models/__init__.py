@@ -6,7 +6,8 @@ from .schemas import (
     RetentionAnalysis,
     EfficiencyTrend,
     FYP_APE_TIERS,
-    get_tier
+    get_tier,
+    get_tiers
 )
 
 __all__ = [
@@ -17,5 +18,6 @@ __all__ = [
     'RetentionAnalysis',
     'EfficiencyTrend',
     'FYP_APE_TIERS',
-    'get_tier'
+    'get_tier',
+    'get_tiers'
 ]
@@ -1,12 +1,14 @@
 """
 数据模型定义
 """
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, fields
 from typing import Optional, List
 from datetime import date
 
+import numpy as np
 
-@dataclass
+
+@dataclass(slots=True)
 class Agent:
     """经纪人数据模型"""
     agent_id: int
@@ -41,10 +43,11 @@ class Agent:
     md_qualified_2025: bool = False
 
     def to_dict(self):
-        return asdict(self)
+        # 扁平记录逐字段取值即可，避免asdict的递归深拷贝
+        return {f.name: getattr(self, f.name) for f in fields(self)}
 
 
-@dataclass
+@dataclass(slots=True)
 class PointsRecord:
     """积分记录模型"""
     agent_id: int
@@ -60,7 +63,7 @@ class PointsRecord:
     remark: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class SocialSecurityRecord:
     """社保公积金记录模型"""
     name: str
@@ -71,7 +74,7 @@ class SocialSecurityRecord:
     matched_agent_id: Optional[int] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MarginAnalysis:
     """边际贡献分析结果"""
     group_name: str
@@ -88,7 +91,7 @@ class MarginAnalysis:
     avg_margin: float
 
 
-@dataclass
+@dataclass(slots=True)
 class RetentionAnalysis:
     """留存分析结果"""
     group_name: str
@@ -102,7 +105,7 @@ class RetentionAnalysis:
     amount_retention_rate: float
 
 
-@dataclass
+@dataclass(slots=True)
 class EfficiencyTrend:
     """人效走势"""
     group_name: str
@@ -126,9 +129,28 @@ FYP_APE_TIERS = [
 ]
 
 
+# 分层边界和标签（供向量化查找）
+_TIER_BOUNDS = np.array([tier[0] for tier in FYP_APE_TIERS[1:]])
+_TIER_LABELS = np.array([tier[2] for tier in FYP_APE_TIERS])
+
+
 def get_tier(value: float) -> str:
     """根据金额获取分层"""
     for low, high, label in FYP_APE_TIERS:
         if low <= value < high:
             return label
     return "50万+"
+
+
+def get_tiers(values) -> np.ndarray:
+    """
+    向量化分层：对整列金额做一次searchsorted二分查找
+
+    Args:
+        values: 金额数组（或pandas Series）
+
+    Returns:
+        与输入等长的分层标签数组
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return _TIER_LABELS[np.searchsorted(_TIER_BOUNDS, values, side='right')]
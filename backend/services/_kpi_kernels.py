@@ -0,0 +1,59 @@
+"""
+KPI计算的数值内核
+
+按分组整数码做单遍统计。装了numba时走JIT内核（掩码、计数、
+求和融合为一次循环），否则退回NumPy的bincount实现（两次C级遍历）
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _year_stats_numpy(
+    fyp: np.ndarray,
+    values: np.ndarray,
+    codes: np.ndarray,
+    n_groups: int
+) -> tuple:
+    """按分组码统计当年出单人数和指标合计
+
+    Args:
+        fyp: 当年FYP列向量（出单判定依据）
+        values: 当年指标列向量（被求和的值）
+        codes: 每行的分组整数码
+        n_groups: 分组数
+
+    Returns:
+        (每组出单人数, 每组指标合计)
+    """
+    active = fyp > 0
+    active_codes = codes[active]
+    counts = np.bincount(active_codes, minlength=n_groups)
+    totals = np.bincount(
+        active_codes, weights=values[active], minlength=n_groups
+    )
+    return counts, totals
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _year_stats_jit(fyp, values, codes, n_groups):
+        counts = np.zeros(n_groups, np.int64)
+        totals = np.zeros(n_groups, np.float64)
+        for i in range(fyp.size):
+            if fyp[i] > 0:
+                group = codes[i]
+                counts[group] += 1
+                totals[group] += values[i]
+        return counts, totals
+
+    year_stats = _year_stats_jit
+    # 导入时预热JIT，首个请求不付编译开销
+    year_stats(
+        np.zeros(1), np.zeros(1), np.zeros(1, dtype=np.int64), 1
+    )
+else:
+    year_stats = _year_stats_numpy
@@ -2,43 +2,101 @@
 数据匹配服务
 用于社保公积金数据与经纪人的模糊匹配
 """
+import functools
+import itertools
+import math
+from collections import defaultdict
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 from pypinyin import lazy_pinyin
+from rapidfuzz import process
+from rapidfuzz.distance import Levenshtein
 from typing import List, Dict, Any, Optional
 import re
 
+# 模糊匹配的相似度阈值
+SIMILARITY_THRESHOLD = 0.8
+
+# 地域别名映射
+REGION_ALIASES = {
+    '北京': ['北京', '京'],
+    '上海': ['上海', '沪'],
+    '广州': ['广州', '穗'],
+    '深圳': ['深圳', '深'],
+    '江苏': ['江苏', '苏', '南京', '苏州', '无锡', '常州', '镇江', '扬州'],
+    '浙江': ['浙江', '浙', '杭州', '宁波', '温州', '绍兴'],
+    '广东': ['广东', '粤', '东莞', '佛山', '珠海', '中山'],
+    '山东': ['山东', '鲁', '济南', '青岛', '烟台'],
+    '四川': ['四川', '川', '成都'],
+    '湖北': ['湖北', '鄂', '武汉'],
+    '湖南': ['湖南', '湘', '长沙'],
+    '河南': ['河南', '豫', '郑州'],
+    '河北': ['河北', '冀', '石家庄'],
+    '福建': ['福建', '闽', '福州', '厦门'],
+    '安徽': ['安徽', '皖', '合肥'],
+    '辽宁': ['辽宁', '辽', '沈阳', '大连'],
+    '陕西': ['陕西', '陕', '西安'],
+    '天津': ['天津', '津'],
+    '重庆': ['重庆', '渝'],
+}
+
+# 反向映射：别名 -> 标准地域
+_ALIAS_TO_REGION = {
+    alias: region
+    for region, aliases in REGION_ALIASES.items()
+    for alias in aliases
+}
+
+# Aho-Corasick自动机：一次扫描即可在地域串中找到别名
+if ahocorasick is not None:
+    _REGION_AUTOMATON = ahocorasick.Automaton()
+    for _alias, _region in _ALIAS_TO_REGION.items():
+        _REGION_AUTOMATON.add_word(_alias, (_alias, _region))
+    _REGION_AUTOMATON.make_automaton()
+else:
+    _REGION_AUTOMATON = None
+
+# 正则备选：同样是C级单次扫描，长别名在前保证'苏州'先于'苏'命中
+_REGION_RE = re.compile('|'.join(
+    re.escape(alias)
+    for alias in sorted(_ALIAS_TO_REGION, key=len, reverse=True)
+))
+
+# 姓名清洗：保留汉字和英文字母
+_CLEAN_RE = re.compile(r'[^一-龥a-zA-Z]')
+
+
+@functools.lru_cache(maxsize=65536)
+def _to_pinyin_cached(name: str) -> str:
+    """将姓名转换为拼音（小写无空格），同名重复调用走缓存"""
+    cleaned = _CLEAN_RE.sub('', name)
+    return ''.join(lazy_pinyin(cleaned)).lower()
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_region_cached(region: str) -> str:
+    """标准化地域名称，重复地域串走缓存"""
+    if _REGION_AUTOMATON is not None:
+        # 自动机单次扫描取第一个命中（同一位置优先最长别名，如'南京'优于'京'）
+        for _, (alias, std) in _REGION_AUTOMATON.iter(region):
+            return std
+        return region
+
+    match = _REGION_RE.search(region)
+    return _ALIAS_TO_REGION[match.group(0)] if match else region
+
 
 class DataMatcher:
     """社保数据模糊匹配器"""
 
     def __init__(self):
-        # 地域别名映射
-        self.region_aliases = {
-            '北京': ['北京', '京'],
-            '上海': ['上海', '沪'],
-            '广州': ['广州', '穗'],
-            '深圳': ['深圳', '深'],
-            '江苏': ['江苏', '苏', '南京', '苏州', '无锡', '常州', '镇江', '扬州'],
-            '浙江': ['浙江', '浙', '杭州', '宁波', '温州', '绍兴'],
-            '广东': ['广东', '粤', '东莞', '佛山', '珠海', '中山'],
-            '山东': ['山东', '鲁', '济南', '青岛', '烟台'],
-            '四川': ['四川', '川', '成都'],
-            '湖北': ['湖北', '鄂', '武汉'],
-            '湖南': ['湖南', '湘', '长沙'],
-            '河南': ['河南', '豫', '郑州'],
-            '河北': ['河北', '冀', '石家庄'],
-            '福建': ['福建', '闽', '福州', '厦门'],
-            '安徽': ['安徽', '皖', '合肥'],
-            '辽宁': ['辽宁', '辽', '沈阳', '大连'],
-            '陕西': ['陕西', '陕', '西安'],
-            '天津': ['天津', '津'],
-            '重庆': ['重庆', '渝'],
-        }
-
-        # 构建反向映射
-        self.alias_to_region = {}
-        for region, aliases in self.region_aliases.items():
-            for alias in aliases:
-                self.alias_to_region[alias] = region
+        self.region_aliases = REGION_ALIASES
+        self.alias_to_region = _ALIAS_TO_REGION
+        # 最近一次match_social_security的命中数，供报告复用
+        self.last_matched_count = None
 
     def match_social_security(
         self,
@@ -55,95 +113,187 @@ class DataMatcher:
         Returns:
             添加了matched_agent_id的社保记录列表
         """
-        # 构建经纪人索引：(拼音, 标准化地域) -> agent_id
+        # 构建按地域分桶的经纪人索引
         agent_index = self._build_agent_index(agents)
 
-        matched_count = 0
+        # 同一员工的社保记录逐月重复，先按(姓名, 地域)去重
+        # 每个唯一组合只解析一次，结果广播到组内所有记录
+        record_groups = defaultdict(list)
         for record in ss_records:
             name = record.get('name', '')
-            region = record.get('region', '')
-
             if not name:
                 continue
+            record_groups[(name, record.get('region', '') or '')].append(record)
 
-            # 尝试匹配
-            agent_id = self._find_match(name, region, agent_index)
+        matched_count = 0
+        # 第一轮：精确匹配（拼音+地域），剩余的按地域攒成批次
+        pending = defaultdict(list)
+        for (name, region), records in record_groups.items():
+            pinyin = self._to_pinyin(name)
+            std_region = self._normalize_region(region)
+            agent_id = self._exact_match(pinyin, std_region, agent_index)
 
             if agent_id:
-                record['matched_agent_id'] = agent_id
-                matched_count += 1
+                for record in records:
+                    record['matched_agent_id'] = agent_id
+                matched_count += len(records)
+            else:
+                pending[(std_region, len(pinyin))].append((records, pinyin))
+
+        # 第二轮：按(地域, 拼音长度)批量模糊匹配
+        # 长度差超过阈值允许范围的候选不可能达标，按长度分桶裁剪候选集
+        for (std_region, length), items in pending.items():
+            pinyins, agent_ids = self._candidate_pool(
+                std_region, agent_index, length=length
+            )
+            if not pinyins:
+                continue
 
+            queries = [pinyin for _, pinyin in items]
+            scores = process.cdist(
+                queries, pinyins,
+                scorer=Levenshtein.normalized_similarity,
+                score_cutoff=SIMILARITY_THRESHOLD,
+                workers=-1
+            )
+
+            for row, (records, _) in zip(scores, items):
+                best = int(row.argmax())
+                if row[best] > 0:
+                    for record in records:
+                        record['matched_agent_id'] = agent_ids[best]
+                    matched_count += len(records)
+
+        self.last_matched_count = matched_count
         return ss_records
 
-    def _build_agent_index(self, agents: List[Dict]) -> Dict[tuple, int]:
+    def _build_agent_index(self, agents: List[Dict]) -> Dict[str, Dict[str, Any]]:
         """
-        构建经纪人索引
+        构建按标准化地域分桶的经纪人索引
 
         Returns:
-            {(拼音, 地域): agent_id} 的映射
+            {地域: {'exact': {拼音: agent_id}, 'pinyins': [...], 'agent_ids': [...]}}
         """
         index = {}
 
         for agent in agents:
+            # 没有姓名字段的经纪人无法参与姓名匹配
+            # 实际场景中可能需要从其他数据源获取姓名
+            if 'name' not in agent:
+                continue
+
             agent_id = agent.get('agent_id')
-            region = agent.get('region', '')
+            std_region = self._normalize_region(agent.get('region', '') or '')
+            pinyin = self._to_pinyin(agent['name'])
 
-            # 标准化地域
-            std_region = self._normalize_region(region)
+            bucket = index.setdefault(std_region, {
+                'exact': {},
+                'by_length': defaultdict(list)
+            })
+            bucket['exact'].setdefault(pinyin, agent_id)
+            bucket['by_length'][len(pinyin)].append((pinyin, agent_id))
 
-            # 由于我们没有经纪人姓名，这里假设需要其他方式匹配
-            # 实际场景中可能需要从其他数据源获取姓名
+        return index
 
-            # 如果有姓名字段
-            if 'name' in agent:
-                pinyin = self._to_pinyin(agent['name'])
-                index[(pinyin, std_region)] = agent_id
+    def _exact_match(
+        self,
+        pinyin: str,
+        std_region: str,
+        agent_index: Dict[str, Dict[str, Any]]
+    ) -> Optional[int]:
+        """在兼容地域的桶中查找拼音的精确命中"""
+        for bucket in self._candidate_buckets(std_region, agent_index):
+            if pinyin in bucket['exact']:
+                return bucket['exact'][pinyin]
+        return None
 
-            # 备选：使用agent_id作为key
-            index[('id', agent_id)] = agent_id
+    def _candidate_buckets(
+        self,
+        std_region: str,
+        agent_index: Dict[str, Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """返回与地域兼容的候选桶（地域为空时视为全部兼容）"""
+        if not std_region:
+            return list(agent_index.values())
+
+        buckets = []
+        if std_region in agent_index:
+            buckets.append(agent_index[std_region])
+        if '' in agent_index:
+            buckets.append(agent_index[''])
+        return buckets
+
+    def _length_window(self, length: int) -> tuple:
+        """在相似度阈值下仍可能达标的候选拼音长度区间"""
+        lo = math.ceil(length * SIMILARITY_THRESHOLD)
+        hi = math.floor(length / SIMILARITY_THRESHOLD)
+        return lo, hi
+
+    def _candidate_pool(
+        self,
+        std_region: str,
+        agent_index: Dict[str, Dict[str, Any]],
+        length: Optional[int] = None
+    ) -> tuple:
+        """
+        合并兼容桶中的候选拼音和对应的经纪人ID
 
-        return index
+        指定length时只返回长度在可行区间内的候选
+        """
+        if length is not None:
+            lo, hi = self._length_window(length)
+        pinyins = []
+        agent_ids = []
+        for bucket in self._candidate_buckets(std_region, agent_index):
+            for cand_len, entries in bucket['by_length'].items():
+                if length is not None and not lo <= cand_len <= hi:
+                    continue
+                for pinyin, agent_id in entries:
+                    pinyins.append(pinyin)
+                    agent_ids.append(agent_id)
+        return pinyins, agent_ids
 
     def _find_match(
         self,
         name: str,
         region: str,
-        agent_index: Dict[tuple, int]
+        agent_index: Dict[str, Dict[str, Any]]
     ) -> Optional[int]:
         """
-        查找匹配的经纪人
+        查找单条记录匹配的经纪人
 
         Args:
             name: 社保记录中的姓名
             region: 社保记录中的地域
-            agent_index: 经纪人索引
+            agent_index: 经纪人索引（_build_agent_index的结果）
 
         Returns:
             匹配的经纪人ID，未找到返回None
         """
-        # 转换姓名为拼音
         pinyin = self._to_pinyin(name)
-
-        # 标准化地域
         std_region = self._normalize_region(region)
 
-        # 精确匹配：拼音 + 地域
-        key = (pinyin, std_region)
-        if key in agent_index:
-            return agent_index[key]
-
-        # 模糊匹配：只匹配拼音
-        for (p, r), agent_id in agent_index.items():
-            if p == pinyin:
-                # 检查地域是否兼容
-                if self._regions_compatible(std_region, r):
-                    return agent_id
-
-        # 更模糊的匹配：拼音相似度
-        for (p, r), agent_id in agent_index.items():
+        # 精确匹配：拼音 + 兼容地域
+        agent_id = self._exact_match(pinyin, std_region, agent_index)
+        if agent_id:
+            return agent_id
+
+        # 模糊匹配：拼音相似度（按长度区间裁剪候选）
+        pinyins, agent_ids = self._candidate_pool(
+            std_region, agent_index, length=len(pinyin)
+        )
+        # 长度最接近的候选最可能达标，排序后首个命中即返回
+        candidates = sorted(
+            zip(pinyins, agent_ids),
+            key=lambda item: abs(len(item[0]) - len(pinyin))
+        )
+        length = len(pinyin)
+        for p, candidate_id in candidates:
+            # 长度差超过(1-阈值)·max_len时相似度必然低于阈值，跳过距离计算
+            if abs(len(p) - length) > max(len(p), length) * (1 - SIMILARITY_THRESHOLD):
+                continue
             if self._pinyin_similar(pinyin, p):
-                if self._regions_compatible(std_region, r):
-                    return agent_id
+                return candidate_id
 
         return None
 
@@ -151,26 +301,13 @@ class DataMatcher:
         """将姓名转换为拼音（小写无空格）"""
         if not name:
             return ''
-
-        # 移除空格和特殊字符
-        name = re.sub(r'[^\u4e00-\u9fa5a-zA-Z]', '', name)
-
-        # 转换为拼音
-        pinyin_list = lazy_pinyin(name)
-
-        return ''.join(pinyin_list).lower()
+        return _to_pinyin_cached(name)
 
     def _normalize_region(self, region: str) -> str:
         """标准化地域名称"""
         if not region:
             return ''
-
-        # 查找标准地域名
-        for alias, std in self.alias_to_region.items():
-            if alias in region:
-                return std
-
-        return region
+        return _normalize_region_cached(region)
 
     def _regions_compatible(self, region1: str, region2: str) -> bool:
         """检查两个地域是否兼容（相同或有隶属关系）"""
@@ -191,36 +328,13 @@ class DataMatcher:
         if not pinyin1 or not pinyin2:
             return False
 
-        # 使用简单的编辑距离比较
-        distance = self._levenshtein_distance(pinyin1, pinyin2)
-        max_len = max(len(pinyin1), len(pinyin2))
-
-        if max_len == 0:
-            return True
-
-        similarity = 1 - (distance / max_len)
+        # rapidfuzz的C实现计算归一化编辑距离相似度
+        # score_cutoff让低于阈值的比较提前终止
+        similarity = Levenshtein.normalized_similarity(
+            pinyin1, pinyin2, score_cutoff=threshold
+        )
         return similarity >= threshold
 
-    def _levenshtein_distance(self, s1: str, s2: str) -> int:
-        """计算编辑距离"""
-        if len(s1) < len(s2):
-            return self._levenshtein_distance(s2, s1)
-
-        if len(s2) == 0:
-            return len(s1)
-
-        previous_row = range(len(s2) + 1)
-        for i, c1 in enumerate(s1):
-            current_row = [i + 1]
-            for j, c2 in enumerate(s2):
-                insertions = previous_row[j + 1] + 1
-                deletions = current_row[j] + 1
-                substitutions = previous_row[j] + (c1 != c2)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-
-        return previous_row[-1]
-
     def get_match_report(
         self,
         ss_records: List[Dict[str, Any]]
@@ -235,14 +349,19 @@ class DataMatcher:
             匹配统计报告
         """
         total = len(ss_records)
-        matched = sum(1 for r in ss_records if r.get('matched_agent_id'))
+        # 匹配阶段已统计过命中数，避免再整表扫描一遍
+        if self.last_matched_count is not None:
+            matched = self.last_matched_count
+        else:
+            matched = sum(1 for r in ss_records if r.get('matched_agent_id'))
         unmatched = total - matched
 
-        # 未匹配记录详情
-        unmatched_records = [
+        # 未匹配样本：最多取10条即停，不物化完整的未匹配列表
+        unmatched_samples = [
             {'name': r.get('name'), 'region': r.get('region')}
-            for r in ss_records
-            if not r.get('matched_agent_id')
+            for r in itertools.islice(
+                (r for r in ss_records if not r.get('matched_agent_id')), 10
+            )
         ]
 
         return {
@@ -250,5 +369,5 @@ class DataMatcher:
             'matched_count': matched,
             'unmatched_count': unmatched,
             'match_rate': matched / total if total > 0 else 0,
-            'unmatched_samples': unmatched_records[:10]  # 最多返回10条未匹配样本
+            'unmatched_samples': unmatched_samples
         }
@@ -2,34 +2,140 @@
 数据存储服务
 使用SQLite存储和查询数据
 """
-import sqlite3
 import os
+
+# 可选驱动：pysqlite3-binary自带较新的SQLite（计划器更新、PRAGMA更全），
+# 接口与标准库完全兼容；设SQLITE_DRIVER=pysqlite3启用，缺省走标准库
+if os.getenv('SQLITE_DRIVER') == 'pysqlite3':
+    try:
+        import pysqlite3 as sqlite3
+    except ImportError:
+        import sqlite3
+else:
+    import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 import json
 
+import numpy as np
+import pandas as pd
+
 
 class DataStore:
     """数据存储管理器"""
 
+    # FYP/APE分层区间（与前端筛选项一致）
+    TIER_RANGES = {
+        '0-5万': (0, 50000),
+        '5-10万': (50000, 100000),
+        '10-30万': (100000, 300000),
+        '30-50万': (300000, 500000),
+        '50万+': (500000, float('inf'))
+    }
+
+    # 允许作为分组维度的agents列（防止拼接SQL时注入）
+    GROUPABLE_COLUMNS = {
+        'region', 'join_year', 'personal_level', 'manager_level',
+        'director_level', 'education', 'is_peer'
+    }
+
+    # agents表除主键外的全部列（与CREATE TABLE顺序一致）
+    AGENT_COLUMNS = [
+        'income_2022', 'income_2023', 'income_2024', 'income_2025',
+        'fyp_2022', 'fyp_2023', 'fyp_2024', 'fyp_2025',
+        'ape_2022', 'ape_2023', 'ape_2024', 'ape_2025',
+        'fyc_2022', 'fyc_2023', 'fyc_2024', 'fyc_2025',
+        'education', 'region', 'years', 'personal_level',
+        'manager_level', 'director_level', 'join_date', 'join_year',
+        'team_leader_id', 'is_peer',
+        'md_qualified_2022', 'md_qualified_2023',
+        'md_qualified_2024', 'md_qualified_2025',
+        'updated_at'
+    ]
+
+    # 预编译的agents UPSERT模板：类加载时拼好，逐批只做prepare+bind
+    _AGENT_UPSERT_SQL = '''
+        INSERT INTO agents (agent_id, {cols})
+        VALUES (?, {placeholders})
+        ON CONFLICT(agent_id) DO UPDATE SET {updates}
+    '''.format(
+        cols=', '.join(AGENT_COLUMNS),
+        placeholders=', '.join('?' for _ in AGENT_COLUMNS),
+        updates=', '.join(f'{col} = excluded.{col}' for col in AGENT_COLUMNS)
+    )
+
     def __init__(self, db_path: str):
         self.db_path = db_path
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self._init_db()
+        # 常驻连接：读写各一条，免去每次请求的connect+PRAGMA开销
+        # WAL模式下读写连接互不阻塞，各自用锁串行即可
+        # 读锁可重入，便于在iter_agents的消费循环里再做读查询
+        self._read_lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._read_conn = self._get_conn()
+        self._write_conn = self._get_conn()
+
+    @property
+    def data_version(self) -> int:
+        """当前数据版本号，供上层缓存判断失效
+
+        取SQLite自身的PRAGMA data_version：任何其他连接——包括别的
+        gunicorn工作进程——提交写入后，读连接上的取值都会变化。
+        本实例的写入走独立的写连接，在读连接看来同样是"其他连接"，
+        因此不需要进程内计数器
+        """
+        with self._read_lock:
+            return self._read_conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self) -> None:
+        """关闭常驻连接（按SQLite建议先跑一次PRAGMA optimize）"""
+        with self._write_lock:
+            self._write_conn.execute('PRAGMA optimize')
+            self._write_conn.close()
+        with self._read_lock:
+            self._read_conn.close()
 
     def _get_conn(self):
-        """获取数据库连接"""
-        conn = sqlite3.connect(self.db_path)
+        """新建数据库连接（常驻连接跨线程复用，靠锁保证串行）"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        self._apply_pragmas(conn)
         return conn
 
+    @contextmanager
+    def _read_cursor(self):
+        """常驻读连接的游标"""
+        with self._read_lock:
+            yield self._read_conn.cursor()
+
+    def _apply_pragmas(self, conn):
+        """连接级性能参数"""
+        # WAL下NORMAL已足够安全，省去每次提交的完整fsync
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-65536')      # 64MB页缓存
+        conn.execute('PRAGMA mmap_size=268435456')    # 256MB内存映射读取
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA busy_timeout=5000')      # 写锁竞争时等待而非立即报错
+        conn.execute('PRAGMA foreign_keys=ON')
+
     def _init_db(self):
         """初始化数据库表"""
         conn = self._get_conn()
         cursor = conn.cursor()
 
+        # WAL模式写入文件数据库后对所有连接持久生效
+        # 读写可并发，提交只需顺序追加WAL文件（内存库不支持，跳过）
+        if self.db_path != ':memory:':
+            cursor.execute('PRAGMA journal_mode=WAL')
+
+        # STRICT表（SQLite>=3.37）：按声明类型存储，省去运行时类型协调
+        strict = ' STRICT' if sqlite3.sqlite_version_info >= (3, 37, 0) else ''
+
         # 经纪人主表
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS agents (
                 agent_id INTEGER PRIMARY KEY,
                 income_2022 REAL DEFAULT 0,
@@ -63,13 +169,13 @@ class DataStore:
                 md_qualified_2024 INTEGER DEFAULT 0,
                 md_qualified_2025 INTEGER DEFAULT 0,
                 updated_at TEXT
-            )
+            ){strict}
         ''')
 
         # 积分记录表
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS points (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id INTEGER PRIMARY KEY,
                 agent_id INTEGER,
                 is_active TEXT,
                 transaction_type TEXT,
@@ -83,13 +189,13 @@ class DataStore:
                 order_id TEXT,
                 remark TEXT,
                 FOREIGN KEY (agent_id) REFERENCES agents(agent_id)
-            )
+            ){strict}
         ''')
 
         # 社保公积金记录表
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS social_security (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                id INTEGER PRIMARY KEY,
                 name TEXT,
                 bill_name TEXT,
                 service_month TEXT,
@@ -99,22 +205,77 @@ class DataStore:
                 region TEXT,
                 matched_agent_id INTEGER,
                 FOREIGN KEY (matched_agent_id) REFERENCES agents(agent_id)
-            )
+            ){strict}
         ''')
 
         # ID映射表
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS id_mapping (
                 pe_id TEXT PRIMARY KEY,
                 uid INTEGER UNIQUE
-            )
+            ){strict}
+        ''')
+
+        # 积分按人按年汇总表（save_data后重建，供分析查询直接JOIN）
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS points_agg (
+                agent_id INTEGER,
+                transaction_year INTEGER,
+                granted REAL DEFAULT 0,
+                used REAL DEFAULT 0,
+                PRIMARY KEY (agent_id, transaction_year)
+            ){strict}
+        ''')
+
+        # 社保公积金企业承担按人按年汇总表
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS ss_agg (
+                agent_id INTEGER,
+                year INTEGER,
+                company_total REAL DEFAULT 0,
+                PRIMARY KEY (agent_id, year)
+            ){strict}
+        ''')
+
+        # 上传任务状态表：任务在子进程中处理，状态放数据库里
+        # 才能被gunicorn的任意工作进程查询到
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS upload_jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at TEXT
+            ){strict}
         ''')
 
         # 创建索引
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_agents_region ON agents(region)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_agents_join_year ON agents(join_year)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_agents_region_years
+            ON agents(region, years, personal_level)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_agents_personal_level ON agents(personal_level)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_agents_manager_level ON agents(manager_level)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_points_agent ON points(agent_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_ss_agent ON social_security(matched_agent_id)')
+        # 覆盖索引：汇总查询的过滤、分组和聚合列全部在索引内，免回表
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_points_year_agent_type_amount
+            ON points(transaction_year, agent_id, transaction_type, amount)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_ss_month_agent_company
+            ON social_security(service_month, matched_agent_id, company_total)
+        ''')
+
+        # 数据库跨部署持久存在：旧库第一次跑到这里时汇总表还是空的，
+        # 启动时按现有明细重建一次，保证与points/social_security一致
+        self._refresh_agg_tables(cursor)
+
+        # 建表建索引后刷新统计信息，查询计划器启动即有依据
+        cursor.execute('ANALYZE')
 
         conn.commit()
         conn.close()
@@ -129,7 +290,11 @@ class DataStore:
         Returns:
             保存结果摘要
         """
-        conn = self._get_conn()
+        with self._write_lock:
+            return self._save_data_locked(self._write_conn, parsed_data)
+
+    def _save_data_locked(self, conn, parsed_data: Dict[str, Any]) -> Dict[str, Any]:
+        """在持有写锁的前提下执行全部插入"""
         cursor = conn.cursor()
 
         result = {
@@ -142,128 +307,126 @@ class DataStore:
 
         now = datetime.now().isoformat()
 
-        # 保存经纪人数据（使用UPSERT）
-        for agent in parsed_data.get('agents', []):
-            agent['updated_at'] = now
-
-            # 处理日期字段
-            if 'join_date' in agent and agent['join_date'] is not None:
-                if hasattr(agent['join_date'], 'isoformat'):
-                    agent['join_date'] = agent['join_date'].isoformat()
-
-            # 处理布尔值
-            for year in [2022, 2023, 2024, 2025]:
-                key = f'md_qualified_{year}'
-                if key in agent:
-                    agent[key] = 1 if agent[key] else 0
-
-            columns = [k for k in agent.keys() if k != 'agent_id']
-            placeholders = ', '.join([f'{col} = ?' for col in columns])
-
-            cursor.execute(f'''
-                INSERT INTO agents (agent_id, {', '.join(columns)})
-                VALUES (?, {', '.join(['?' for _ in columns])})
-                ON CONFLICT(agent_id) DO UPDATE SET {placeholders}
-            ''', [agent['agent_id']] + [agent.get(col) for col in columns] +
-                [agent.get(col) for col in columns])
-
-            if cursor.rowcount > 0:
-                result['agents_inserted'] += 1
-
-        # 保存积分数据
-        for point in parsed_data.get('points', []):
-            if 'transaction_time' in point and point['transaction_time'] is not None:
-                if hasattr(point['transaction_time'], 'isoformat'):
-                    point['transaction_time'] = point['transaction_time'].isoformat()
-
-            cursor.execute('''
-                INSERT INTO points (
-                    agent_id, is_active, transaction_type, amount, category,
-                    director_team_amount, transaction_time, transaction_year,
-                    channel, order_name, order_id, remark
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                point.get('agent_id'),
-                point.get('is_active'),
-                point.get('transaction_type'),
-                point.get('amount', 0),
-                point.get('category'),
-                point.get('director_team_amount', 0),
-                point.get('transaction_time'),
-                point.get('transaction_year'),
-                point.get('channel'),
-                point.get('order_name'),
-                point.get('order_id'),
-                point.get('remark')
-            ))
-            result['points_inserted'] += 1
-
-        # 保存社保公积金数据
-        for ss in parsed_data.get('social_security', []):
-            cursor.execute('''
-                INSERT INTO social_security (
-                    name, bill_name, service_month, company_total,
-                    personal_total, total, region, matched_agent_id
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                ss.get('name'),
-                ss.get('bill_name'),
-                ss.get('service_month'),
-                ss.get('company_total', 0),
-                ss.get('personal_total', 0),
-                ss.get('total', 0),
-                ss.get('region'),
-                ss.get('matched_agent_id')
-            ))
-            result['social_security_inserted'] += 1
-
-        # 保存ID映射
-        for pe_id, uid in parsed_data.get('mapping', {}).items():
-            cursor.execute('''
-                INSERT OR REPLACE INTO id_mapping (pe_id, uid)
-                VALUES (?, ?)
-            ''', (pe_id, uid))
-            result['mapping_inserted'] += 1
-
-        conn.commit()
-        conn.close()
+        # 显式写事务：立即取写锁，所有插入在同一事务内一次提交；
+        # 中途任何一批失败都回滚，常驻写连接不会滞留在打开的事务里
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            # 保存经纪人数据（使用UPSERT，固定列集走预编译模板）
+            agents = parsed_data.get('agents', [])
+
+            def agent_rows():
+                for agent in agents:
+                    agent['updated_at'] = now
+
+                    # 处理日期字段
+                    if 'join_date' in agent and agent['join_date'] is not None:
+                        if hasattr(agent['join_date'], 'isoformat'):
+                            agent['join_date'] = agent['join_date'].isoformat()
+
+                    yield [agent['agent_id']] + [
+                        agent.get(col) for col in self.AGENT_COLUMNS
+                    ]
+
+            if agents:
+                cursor.executemany(self._AGENT_UPSERT_SQL, agent_rows())
+            result['agents_inserted'] = len(agents)
+
+            # 保存积分数据：解析器直通DataFrame，按列转成原生值后流式绑定，
+            # 全程不产生字典记录；字典列表路径保留兼容
+            points = parsed_data.get('points', [])
+            if hasattr(points, 'itertuples'):
+                point_rows = self._point_rows_from_frame(points)
+            else:
+                point_rows = self._point_rows_from_records(points)
+
+            if len(points):
+                cursor.executemany('''
+                    INSERT INTO points (
+                        agent_id, is_active, transaction_type, amount, category,
+                        director_team_amount, transaction_time, transaction_year,
+                        channel, order_name, order_id, remark
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', point_rows)
+            result['points_inserted'] = len(points)
+
+            # 保存社保公积金数据
+            ss_records = parsed_data.get('social_security', [])
+            ss_rows = (
+                (
+                    ss.get('name'),
+                    ss.get('bill_name'),
+                    ss.get('service_month'),
+                    ss.get('company_total', 0),
+                    ss.get('personal_total', 0),
+                    ss.get('total', 0),
+                    ss.get('region'),
+                    ss.get('matched_agent_id')
+                )
+                for ss in ss_records
+            )
 
+            if ss_records:
+                cursor.executemany('''
+                    INSERT INTO social_security (
+                        name, bill_name, service_month, company_total,
+                        personal_total, total, region, matched_agent_id
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', ss_rows)
+            result['social_security_inserted'] = len(ss_records)
+
+            # 保存ID映射
+            mapping_rows = list(parsed_data.get('mapping', {}).items())
+            if mapping_rows:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO id_mapping (pe_id, uid)
+                    VALUES (?, ?)
+                ''', mapping_rows)
+            result['mapping_inserted'] = len(mapping_rows)
+
+            # 重建汇总表
+            self._refresh_agg_tables(cursor)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        # 大批量导入后完整刷新统计信息；小增量只跑轻量的PRAGMA optimize，
+        # 由SQLite自行判断哪些表的统计值得重算
+        total_rows = (result['agents_inserted'] + result['points_inserted']
+                      + result['social_security_inserted'])
+        if total_rows >= 1000:
+            conn.execute('ANALYZE')
+        else:
+            conn.execute('PRAGMA optimize')
         return result
 
     def get_filter_options(self) -> Dict[str, List]:
         """获取所有筛选器的可选值"""
-        conn = self._get_conn()
-        cursor = conn.cursor()
-
         options = {}
 
-        # 区域
-        cursor.execute('SELECT DISTINCT region FROM agents WHERE region IS NOT NULL')
-        options['regions'] = [row[0] for row in cursor.fetchall()]
-
-        # 入职年份
-        cursor.execute('SELECT DISTINCT join_year FROM agents WHERE join_year IS NOT NULL ORDER BY join_year')
-        options['join_years'] = [row[0] for row in cursor.fetchall()]
-
-        # 是否同业
-        cursor.execute('SELECT DISTINCT is_peer FROM agents WHERE is_peer IS NOT NULL')
-        options['is_peer'] = [row[0] for row in cursor.fetchall()]
-
-        # 个人职级
-        cursor.execute('SELECT DISTINCT personal_level FROM agents WHERE personal_level IS NOT NULL')
-        options['personal_levels'] = [row[0] for row in cursor.fetchall()]
-
-        # 经理职级
-        cursor.execute('SELECT DISTINCT manager_level FROM agents WHERE manager_level IS NOT NULL')
-        options['manager_levels'] = [row[0] for row in cursor.fetchall()]
-
-        # 总监职级
-        cursor.execute('SELECT DISTINCT director_level FROM agents WHERE director_level IS NOT NULL')
-        options['director_levels'] = [row[0] for row in cursor.fetchall()]
-
-        # 学历
-        cursor.execute('SELECT DISTINCT education FROM agents WHERE education IS NOT NULL')
-        options['educations'] = [row[0] for row in cursor.fetchall()]
+        # 一次扫描取全部筛选列，Python侧用set求去重值，免去7次整表扫描
+        with self._read_cursor() as cursor:
+            cursor.execute('''
+                SELECT region, join_year, is_peer, personal_level,
+                       manager_level, director_level, education
+                FROM agents
+            ''')
+            rows = cursor.fetchall()
+
+        distincts = [set() for _ in range(7)]
+        for row in rows:
+            for values, value in zip(distincts, row):
+                if value is not None:
+                    values.add(value)
+
+        options['regions'] = sorted(distincts[0])
+        options['join_years'] = sorted(distincts[1])
+        options['is_peer'] = sorted(distincts[2])
+        options['personal_levels'] = sorted(distincts[3])
+        options['manager_levels'] = sorted(distincts[4])
+        options['director_levels'] = sorted(distincts[5])
+        options['educations'] = sorted(distincts[6])
 
         # FYP/APE分层
         options['fyp_tiers'] = ['0-5万', '5-10万', '10-30万', '30-50万', '50万+']
@@ -275,19 +438,138 @@ class DataStore:
         # 统计年份
         options['years'] = [2022, 2023, 2024, 2025]
 
-        conn.close()
         return options
 
     def clear_all_data(self) -> None:
         """清空所有业务数据"""
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM points')
-        cursor.execute('DELETE FROM social_security')
-        cursor.execute('DELETE FROM agents')
-        cursor.execute('DELETE FROM id_mapping')
-        conn.commit()
-        conn.close()
+        with self._write_lock:
+            conn = self._write_conn
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM points')
+            cursor.execute('DELETE FROM social_security')
+            cursor.execute('DELETE FROM agents')
+            cursor.execute('DELETE FROM id_mapping')
+            cursor.execute('DELETE FROM points_agg')
+            cursor.execute('DELETE FROM ss_agg')
+            conn.commit()
+
+    def create_upload_job(self, job_id: str) -> None:
+        """登记一个处理中的上传任务（入库后对所有工作进程可见）"""
+        with self._write_lock:
+            self._write_conn.execute('''
+                INSERT OR REPLACE INTO upload_jobs (job_id, status, created_at)
+                VALUES (?, 'processing', ?)
+            ''', (job_id, datetime.now().isoformat()))
+            self._write_conn.commit()
+
+    def finish_upload_job(
+        self,
+        job_id: str,
+        result: Dict[str, Any] = None,
+        error: str = None
+    ) -> None:
+        """记录上传任务的最终状态（成功摘要或错误信息）"""
+        status = 'error' if error is not None else 'done'
+        with self._write_lock:
+            self._write_conn.execute('''
+                UPDATE upload_jobs SET status = ?, result = ?, error = ?
+                WHERE job_id = ?
+            ''', (
+                status,
+                json.dumps(result) if result is not None else None,
+                error,
+                job_id
+            ))
+            self._write_conn.commit()
+
+    def pop_upload_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """查询上传任务状态；已结束的任务取出后即删除记录"""
+        with self._read_cursor() as cursor:
+            cursor.execute('''
+                SELECT status, result, error FROM upload_jobs WHERE job_id = ?
+            ''', (job_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+
+        job = {
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error']
+        }
+        if job['status'] != 'processing':
+            with self._write_lock:
+                self._write_conn.execute(
+                    'DELETE FROM upload_jobs WHERE job_id = ?', (job_id,)
+                )
+                self._write_conn.commit()
+        return job
+
+    # points表插入列的顺序（与INSERT语句一致）
+    _POINT_FIELDS = (
+        'agent_id', 'is_active', 'transaction_type', 'amount', 'category',
+        'director_team_amount', 'transaction_time', 'transaction_year',
+        'channel', 'order_name', 'order_id', 'remark'
+    )
+
+    def _point_rows_from_frame(self, df):
+        """把积分DataFrame按列转为原生Python值并逐行产出绑定参数"""
+        columns = []
+        for field in self._POINT_FIELDS:
+            if field in df.columns:
+                series = df[field]
+                if field == 'transaction_time' and str(series.dtype).startswith('datetime'):
+                    series = series.dt.strftime('%Y-%m-%dT%H:%M:%S')
+                # tolist把numpy标量转回原生类型；可空整数的NA转为None
+                values = [
+                    None if value is pd.NA or value != value else value
+                    for value in series.tolist()
+                ]
+            else:
+                default = 0 if field in ('amount', 'director_team_amount') else None
+                values = [default] * len(df)
+            columns.append(values)
+
+        return zip(*columns)
+
+    def _point_rows_from_records(self, points: List[Dict]):
+        """从字典记录逐行产出积分绑定参数"""
+        for point in points:
+            if 'transaction_time' in point and point['transaction_time'] is not None:
+                if hasattr(point['transaction_time'], 'isoformat'):
+                    point['transaction_time'] = point['transaction_time'].isoformat()
+
+            yield tuple(
+                point.get(field, 0 if field in ('amount', 'director_team_amount') else None)
+                for field in self._POINT_FIELDS
+            )
+
+    def _refresh_agg_tables(self, cursor) -> None:
+        """重建积分/社保的按人按年汇总表"""
+        cursor.execute('DELETE FROM points_agg')
+        cursor.execute('''
+            INSERT INTO points_agg (agent_id, transaction_year, granted, used)
+            SELECT
+                agent_id,
+                transaction_year,
+                SUM(CASE WHEN transaction_type = '积分发放' THEN amount ELSE 0 END),
+                SUM(CASE WHEN transaction_type = '积分扣减' THEN ABS(amount) ELSE 0 END)
+            FROM points
+            WHERE agent_id IS NOT NULL AND transaction_year IS NOT NULL
+            GROUP BY agent_id, transaction_year
+        ''')
+
+        cursor.execute('DELETE FROM ss_agg')
+        cursor.execute('''
+            INSERT INTO ss_agg (agent_id, year, company_total)
+            SELECT
+                matched_agent_id,
+                CAST(substr(service_month, 1, 4) AS INTEGER),
+                SUM(company_total)
+            FROM social_security
+            WHERE matched_agent_id IS NOT NULL AND service_month IS NOT NULL
+            GROUP BY matched_agent_id, CAST(substr(service_month, 1, 4) AS INTEGER)
+        ''')
 
     def get_agents(self, filters: Dict[str, Any] = None, year: int = 2024) -> List[Dict]:
         """
@@ -300,119 +582,284 @@ class DataStore:
         Returns:
             经纪人列表
         """
-        conn = self._get_conn()
-        cursor = conn.cursor()
+        return list(self.iter_agents(filters, year))
+
+    def iter_agents(
+        self,
+        filters: Dict[str, Any] = None,
+        year: int = 2024,
+        columns: Optional[List[str]] = None
+    ):
+        """
+        流式迭代符合条件的经纪人
+
+        按批fetchmany并用元组行组装字典，免去sqlite3.Row的按名查找，
+        大结果集无需整体驻留内存；columns可只投影需要的列
+
+        Args:
+            filters: 筛选条件
+            year: 统计年份
+            columns: 需要的列名子集，None表示全部列
+
+        Yields:
+            经纪人字典
+        """
+        all_columns = ['agent_id'] + self.AGENT_COLUMNS
+        if columns:
+            invalid = set(columns) - set(all_columns)
+            if invalid:
+                raise ValueError(f'不支持的列: {sorted(invalid)}')
+            cols = list(columns)
+            select = ', '.join(cols)
+        else:
+            # SELECT *的列序与建表一致
+            cols = all_columns
+            select = '*'
+
+        conditions, params = self._build_agent_conditions(filters, year)
+        query = f'SELECT {select} FROM agents WHERE 1=1' + conditions
+
+        with self._read_cursor() as cursor:
+            cursor.row_factory = None
+            cursor.execute(query, params)
+            while batch := cursor.fetchmany(1000):
+                for row in batch:
+                    yield dict(zip(cols, row))
+
+    def get_agent_frame(
+        self,
+        filters: Dict[str, Any] = None,
+        year: int = 2024,
+        columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """
+        按筛选条件获取经纪人的列式框架
 
-        query = 'SELECT * FROM agents WHERE 1=1'
+        元组行整批构造DataFrame，不经过逐行字典物化；
+        columns可只投影需要的列，省掉用不到的列的内存和拷贝
+
+        Args:
+            filters: 筛选条件
+            year: 统计年份
+            columns: 需要的列名子集，None表示全部列
+
+        Returns:
+            每列对应一个字段的DataFrame
+        """
+        all_columns = ['agent_id'] + self.AGENT_COLUMNS
+        if columns:
+            invalid = set(columns) - set(all_columns)
+            if invalid:
+                raise ValueError(f'不支持的列: {sorted(invalid)}')
+            cols = list(columns)
+            select = ', '.join(cols)
+        else:
+            cols = all_columns
+            select = '*'
+
+        conditions, params = self._build_agent_conditions(filters, year)
+        query = f'SELECT {select} FROM agents WHERE 1=1' + conditions
+
+        with self._read_cursor() as cursor:
+            cursor.row_factory = None
+            rows = cursor.execute(query, params).fetchall()
+
+        return pd.DataFrame(rows, columns=cols)
+
+    def _build_agent_conditions(
+        self,
+        filters: Dict[str, Any] = None,
+        year: int = 2024
+    ) -> tuple:
+        """构建经纪人筛选的SQL条件（' AND ...'形式）和参数列表"""
+        conditions = ''
         params = []
 
         if filters:
             if filters.get('region'):
-                query += ' AND region = ?'
+                conditions += ' AND region = ?'
                 params.append(filters['region'])
 
             if filters.get('join_year'):
-                query += ' AND join_year = ?'
+                conditions += ' AND join_year = ?'
                 params.append(filters['join_year'])
 
             if filters.get('is_peer'):
-                query += ' AND is_peer = ?'
+                conditions += ' AND is_peer = ?'
                 params.append(filters['is_peer'])
 
             if filters.get('personal_level'):
-                query += ' AND personal_level = ?'
+                conditions += ' AND personal_level = ?'
                 params.append(filters['personal_level'])
 
             if filters.get('manager_level'):
-                query += ' AND manager_level = ?'
+                conditions += ' AND manager_level = ?'
                 params.append(filters['manager_level'])
 
             if filters.get('director_level'):
-                query += ' AND director_level = ?'
+                conditions += ' AND director_level = ?'
                 params.append(filters['director_level'])
 
             if filters.get('md_qualified'):
                 col = f'md_qualified_{year}'
                 if filters['md_qualified'] == '符合':
-                    query += f' AND {col} = 1'
+                    conditions += f' AND {col} = 1'
                 else:
-                    query += f' AND {col} = 0'
+                    conditions += f' AND {col} = 0'
 
             # FYP分层筛选
             if filters.get('fyp_tier'):
-                fyp_col = f'fyp_{year}'
-                tier = filters['fyp_tier']
-                query += self._get_tier_condition(fyp_col, tier)
+                cond, tier_params = self._get_tier_condition(
+                    f'fyp_{year}', filters['fyp_tier']
+                )
+                conditions += cond
+                params.extend(tier_params)
 
             # APE分层筛选
             if filters.get('ape_tier'):
-                ape_col = f'ape_{year}'
-                tier = filters['ape_tier']
-                query += self._get_tier_condition(ape_col, tier)
+                cond, tier_params = self._get_tier_condition(
+                    f'ape_{year}', filters['ape_tier']
+                )
+                conditions += cond
+                params.extend(tier_params)
 
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        return conditions, params
+
+    def get_margin_by_group(
+        self,
+        group_field: str,
+        filters: Dict[str, Any] = None,
+        year: int = 2024
+    ) -> List[Dict]:
+        """
+        按分组维度在SQL中一次性聚合边际贡献的组成项
+
+        聚合在SQLite内完成，避免把每个经纪人的行拉回Python再累加
+
+        Args:
+            group_field: 分组列名（agents表的列）
+            filters: 筛选条件
+            year: 统计年份
+
+        Returns:
+            每组一行：group_name、agent_count及FYC/收入/FYP/APE/积分/社保合计
+        """
+        if group_field not in self.GROUPABLE_COLUMNS:
+            raise ValueError(f'不支持的分组维度: {group_field}')
+        year = int(year)
+
+        conditions, params = self._build_agent_conditions(filters, year)
+
+        query = f'''
+            SELECT
+                a.{group_field} AS group_name,
+                COUNT(*) AS agent_count,
+                SUM(a.fyc_{year}) AS total_fyc,
+                SUM(a.income_{year}) AS total_income,
+                SUM(a.fyp_{year}) AS total_fyp,
+                SUM(a.ape_{year}) AS total_ape,
+                SUM(COALESCE(p.granted, 0) - COALESCE(p.used, 0)) AS total_points,
+                SUM(COALESCE(s.company_total, 0)) AS total_social_security
+            FROM agents a
+            LEFT JOIN points_agg p
+                ON p.agent_id = a.agent_id AND p.transaction_year = ?
+            LEFT JOIN ss_agg s
+                ON s.agent_id = a.agent_id AND s.year = ?
+            WHERE 1=1{conditions}
+            GROUP BY a.{group_field}
+        '''
+
+        with self._read_cursor() as cursor:
+            cursor.execute(query, [year, year] + params)
+            rows = cursor.fetchall()
 
         return [dict(row) for row in rows]
 
-    def _get_tier_condition(self, column: str, tier: str) -> str:
-        """根据分层返回SQL条件"""
-        tier_ranges = {
-            '0-5万': (0, 50000),
-            '5-10万': (50000, 100000),
-            '10-30万': (100000, 300000),
-            '30-50万': (300000, 500000),
-            '50万+': (500000, float('inf'))
-        }
+    def _get_tier_condition(self, column: str, tier: str) -> tuple:
+        """根据分层返回SQL条件和绑定参数"""
+        if tier not in self.TIER_RANGES:
+            return '', []
+
+        low, high = self.TIER_RANGES[tier]
+        if high == float('inf'):
+            return f' AND {column} >= ?', [low]
+        return f' AND {column} >= ? AND {column} < ?', [low, high]
+
+    def get_agents_tier_histogram(
+        self,
+        year: int = 2024,
+        metric: str = 'fyp'
+    ) -> Dict[str, int]:
+        """
+        统计FYP/APE各分层的人数
 
-        if tier in tier_ranges:
-            low, high = tier_ranges[tier]
+        全部分层在一条SUM(CASE ...)查询中算出，只扫描agents一次
+
+        Args:
+            year: 统计年份
+            metric: 'fyp'或'ape'
+
+        Returns:
+            {分层名: 人数}
+        """
+        if metric not in ('fyp', 'ape'):
+            raise ValueError(f'不支持的分层指标: {metric}')
+        column = f'{metric}_{int(year)}'
+
+        selects = []
+        params = []
+        for low, high in self.TIER_RANGES.values():
             if high == float('inf'):
-                return f' AND {column} >= {low}'
-            return f' AND {column} >= {low} AND {column} < {high}'
-        return ''
+                selects.append(f'SUM(CASE WHEN {column} >= ? THEN 1 ELSE 0 END)')
+                params.append(low)
+            else:
+                selects.append(
+                    f'SUM(CASE WHEN {column} >= ? AND {column} < ? THEN 1 ELSE 0 END)'
+                )
+                params.extend([low, high])
 
-    def get_agent_detail(self, agent_id: int) -> Optional[Dict]:
-        """获取经纪人详情"""
-        conn = self._get_conn()
-        cursor = conn.cursor()
+        with self._read_cursor() as cursor:
+            cursor.execute(f'SELECT {", ".join(selects)} FROM agents', params)
+            row = cursor.fetchone()
 
-        # 获取经纪人基本信息
-        cursor.execute('SELECT * FROM agents WHERE agent_id = ?', (agent_id,))
-        agent = cursor.fetchone()
+        return {tier: count or 0 for tier, count in zip(self.TIER_RANGES, row)}
 
-        if not agent:
-            conn.close()
-            return None
+    def get_agent_detail(self, agent_id: int) -> Optional[Dict]:
+        """获取经纪人详情"""
+        with self._read_cursor() as cursor:
+            # 获取经纪人基本信息
+            cursor.execute('SELECT * FROM agents WHERE agent_id = ?', (agent_id,))
+            agent = cursor.fetchone()
 
-        result = dict(agent)
+            if not agent:
+                return None
 
-        # 获取积分汇总
-        cursor.execute('''
-            SELECT
-                transaction_year,
-                transaction_type,
-                SUM(amount) as total_amount
-            FROM points
-            WHERE agent_id = ?
-            GROUP BY transaction_year, transaction_type
-        ''', (agent_id,))
-        result['points_summary'] = [dict(row) for row in cursor.fetchall()]
+            result = dict(agent)
 
-        # 获取社保公积金汇总
-        cursor.execute('''
-            SELECT
-                service_month,
-                company_total,
-                personal_total
-            FROM social_security
-            WHERE matched_agent_id = ?
-            ORDER BY service_month
-        ''', (agent_id,))
-        result['social_security'] = [dict(row) for row in cursor.fetchall()]
+            # 获取积分汇总
+            cursor.execute('''
+                SELECT
+                    transaction_year,
+                    transaction_type,
+                    SUM(amount) as total_amount
+                FROM points
+                WHERE agent_id = ?
+                GROUP BY transaction_year, transaction_type
+            ''', (agent_id,))
+            result['points_summary'] = [dict(row) for row in cursor.fetchall()]
+
+            # 获取社保公积金汇总
+            cursor.execute('''
+                SELECT
+                    service_month,
+                    company_total,
+                    personal_total
+                FROM social_security
+                WHERE matched_agent_id = ?
+                ORDER BY service_month
+            ''', (agent_id,))
+            result['social_security'] = [dict(row) for row in cursor.fetchall()]
 
-        conn.close()
         return result
 
     def get_agents_by_group(
@@ -429,7 +876,7 @@ class DataStore:
 
     def get_points_summary(self, agent_ids: List[int] = None, year: int = 2024) -> Dict[int, Dict]:
         """
-        获取积分汇总
+        获取积分汇总（get_points_frame的字典形式兼容包装）
 
         Args:
             agent_ids: 经纪人ID列表，None表示全部
@@ -438,9 +885,26 @@ class DataStore:
         Returns:
             按经纪人ID索引的积分汇总
         """
-        conn = self._get_conn()
-        cursor = conn.cursor()
+        return self.get_points_frame(agent_ids, year).to_dict('index')
 
+    def get_points_frame(
+        self,
+        agent_ids: List[int] = None,
+        year: int = 2024
+    ) -> pd.DataFrame:
+        """
+        获取积分汇总的列式DataFrame
+
+        以agent_id为索引，granted/used/net三列连续存储，
+        下游聚合可直接做向量化运算而非逐字典取值
+
+        Args:
+            agent_ids: 经纪人ID列表，None表示全部
+            year: 统计年份
+
+        Returns:
+            积分汇总DataFrame
+        """
         query = '''
             SELECT
                 agent_id,
@@ -458,18 +922,16 @@ class DataStore:
 
         query += ' GROUP BY agent_id'
 
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        with self._read_cursor() as cursor:
+            cursor.row_factory = None
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
 
-        return {
-            row['agent_id']: {
-                'granted': row['granted'] or 0,
-                'used': row['used'] or 0,
-                'net': (row['granted'] or 0) - (row['used'] or 0)
-            }
-            for row in rows
-        }
+        df = pd.DataFrame(rows, columns=['agent_id', 'granted', 'used'])
+        df['granted'] = df['granted'].fillna(0)
+        df['used'] = df['used'].fillna(0)
+        df['net'] = df['granted'] - df['used']
+        return df.set_index('agent_id')
 
     def get_social_security_summary(
         self,
@@ -477,7 +939,7 @@ class DataStore:
         year: int = 2024
     ) -> Dict[int, float]:
         """
-        获取社保公积金企业承担汇总
+        获取社保公积金企业承担汇总（get_social_security_frame的兼容包装）
 
         Args:
             agent_ids: 经纪人ID列表
@@ -486,17 +948,34 @@ class DataStore:
         Returns:
             按经纪人ID索引的企业承担金额
         """
-        conn = self._get_conn()
-        cursor = conn.cursor()
+        return self.get_social_security_frame(agent_ids, year)['total'].to_dict()
+
+    def get_social_security_frame(
+        self,
+        agent_ids: List[int] = None,
+        year: int = 2024
+    ) -> pd.DataFrame:
+        """
+        获取社保公积金企业承担汇总的列式DataFrame
 
+        以agent_id为索引，total一列，便于向量化消费
+
+        Args:
+            agent_ids: 经纪人ID列表
+            year: 统计年份
+
+        Returns:
+            企业承担金额DataFrame
+        """
         query = '''
             SELECT
                 matched_agent_id,
                 SUM(company_total) as total
             FROM social_security
-            WHERE service_month LIKE ?
+            WHERE service_month >= ? AND service_month < ?
         '''
-        params = [f'{year}%']
+        # 字符串区间谓词可走索引范围扫描，LIKE '2024%' 则不行
+        params = [str(year), str(year + 1)]
 
         if agent_ids:
             placeholders = ','.join(['?' for _ in agent_ids])
@@ -505,46 +984,71 @@ class DataStore:
 
         query += ' GROUP BY matched_agent_id'
 
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
-
-        return {
-            row['matched_agent_id']: row['total'] or 0
-            for row in rows
-        }
-
-    def get_data_summary(self) -> Dict[str, Any]:
-        """获取数据概览"""
-        conn = self._get_conn()
-        cursor = conn.cursor()
-
-        summary = {}
+        with self._read_cursor() as cursor:
+            cursor.row_factory = None
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
 
-        # 经纪人总数
-        cursor.execute('SELECT COUNT(*) FROM agents')
-        summary['total_agents'] = cursor.fetchone()[0]
+        df = pd.DataFrame(rows, columns=['agent_id', 'total'])
+        df['total'] = df['total'].fillna(0)
+        return df.set_index('agent_id')
 
-        # 各年出单人数
-        for year in [2022, 2023, 2024, 2025]:
-            cursor.execute(f'SELECT COUNT(*) FROM agents WHERE fyp_{year} > 0')
-            summary[f'active_agents_{year}'] = cursor.fetchone()[0]
+    def get_margin_components(
+        self,
+        agent_ids: List[int],
+        year: int = 2024
+    ) -> tuple:
+        """
+        按agent_ids位置对齐的积分净额与社保企业承担向量
 
-        # 积分记录数
-        cursor.execute('SELECT COUNT(*) FROM points')
-        summary['total_points_records'] = cursor.fetchone()[0]
+        两个float64数组与传入的ID顺序一一对应、无记录补0，
+        可直接参与ufunc运算，调用方无需逐人做字典查找
 
-        # 社保记录数
-        cursor.execute('SELECT COUNT(*) FROM social_security')
-        summary['total_ss_records'] = cursor.fetchone()[0]
+        Args:
+            agent_ids: 经纪人ID列表（决定输出顺序）
+            year: 统计年份
 
-        # 已匹配的社保记录数
-        cursor.execute('SELECT COUNT(*) FROM social_security WHERE matched_agent_id IS NOT NULL')
-        summary['matched_ss_records'] = cursor.fetchone()[0]
+        Returns:
+            (积分净额数组, 社保企业承担数组)
+        """
+        # 显式float64：无记录年份的空框架列是object dtype
+        points = self.get_points_frame(agent_ids, year)['net'] \
+            .reindex(agent_ids).fillna(0).to_numpy(np.float64)
+        ss = self.get_social_security_frame(agent_ids, year)['total'] \
+            .reindex(agent_ids).fillna(0).to_numpy(np.float64)
+        return points, ss
 
-        # 最近一次数据更新时间
-        cursor.execute('SELECT MAX(updated_at) FROM agents')
-        summary['last_updated_at'] = cursor.fetchone()[0]
+    def get_data_summary(self) -> Dict[str, Any]:
+        """获取数据概览"""
+        with self._read_cursor() as cursor:
+            # 经纪人相关指标一次扫描算完：比较表达式返回0/1，SUM即计数
+            cursor.execute('''
+                SELECT
+                    COUNT(*),
+                    SUM(fyp_2022 > 0), SUM(fyp_2023 > 0),
+                    SUM(fyp_2024 > 0), SUM(fyp_2025 > 0),
+                    MAX(updated_at)
+                FROM agents
+            ''')
+            agents_row = cursor.fetchone()
+
+            # 积分/社保记录数：社保表同样只扫描一次
+            cursor.execute('SELECT COUNT(*) FROM points')
+            points_count = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT COUNT(*), SUM(matched_agent_id IS NOT NULL)
+                FROM social_security
+            ''')
+            ss_row = cursor.fetchone()
 
-        conn.close()
-        return summary
+        return {
+            'total_agents': agents_row[0],
+            'active_agents_2022': agents_row[1] or 0,
+            'active_agents_2023': agents_row[2] or 0,
+            'active_agents_2024': agents_row[3] or 0,
+            'active_agents_2025': agents_row[4] or 0,
+            'total_points_records': points_count,
+            'total_ss_records': ss_row[0],
+            'matched_ss_records': ss_row[1] or 0,
+            'last_updated_at': agents_row[5],
+        }
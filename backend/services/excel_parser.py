@@ -2,12 +2,31 @@
 Excel解析服务
 解析保险数据Excel的4个Sheet
 """
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 import pandas as pd
 import numpy as np
 from datetime import datetime
 from typing import Dict, Any, List
 
 
+def _build_region_automaton(regions) -> 'ahocorasick.Automaton':
+    """把地域表编译成Aho-Corasick自动机（未安装时返回None）"""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for region in regions:
+        automaton.add_word(region, region)
+    automaton.make_automaton()
+    return automaton
+
+
 class ExcelParser:
     """Excel文件解析器"""
 
@@ -71,17 +90,46 @@ class ExcelParser:
         '备注': 'remark'
     }
 
-    def parse(self, filepath: str) -> Dict[str, Any]:
+    # 账单名中的地域候选（省份/城市）
+    REGIONS = [
+        '北京', '上海', '广州', '深圳', '天津', '重庆',
+        '江苏', '浙江', '广东', '山东', '河南', '四川',
+        '湖北', '湖南', '河北', '福建', '安徽', '辽宁',
+        '陕西', '江西', '云南', '贵州', '山西', '吉林',
+        '黑龙江', '海南', '甘肃', '青海', '宁夏', '新疆',
+        '西藏', '内蒙古', '广西', '常州', '苏州', '无锡',
+        '南京', '杭州', '宁波', '温州', '成都', '武汉'
+    ]
+
+    # 预编译成单个正则交替，长名在前保证同位置优先整词命中
+    _REGION_RE = re.compile('|'.join(
+        re.escape(region)
+        for region in sorted(REGIONS, key=len, reverse=True)
+    ))
+
+    # Aho-Corasick自动机：逐行路径单次扫描即命中，与地域表规模无关
+    _REGION_AUTOMATON = _build_region_automaton(REGIONS)
+
+    def parse(self, filepath) -> Dict[str, Any]:
         """
         解析Excel文件
 
         Args:
-            filepath: Excel文件路径
+            filepath: Excel文件路径或文件对象
 
         Returns:
             解析后的数据字典
         """
-        xlsx = pd.ExcelFile(filepath)
+        # 文件对象先整体读入，每个线程持有独立的字节流
+        if hasattr(filepath, 'read'):
+            payload = filepath.read()
+
+            def make_source():
+                return io.BytesIO(payload)
+        else:
+            def make_source():
+                return filepath
+
         result = {
             'agents': [],
             'points': [],
@@ -90,21 +138,24 @@ class ExcelParser:
             'summary': {}
         }
 
-        # 解析经纪人主数据
-        if self.SHEET_NAMES['agents'] in xlsx.sheet_names:
-            result['agents'] = self._parse_agents(xlsx)
-
-        # 解析积分数据
-        if self.SHEET_NAMES['points'] in xlsx.sheet_names:
-            result['points'] = self._parse_points(xlsx)
-
-        # 解析社保公积金数据
-        if self.SHEET_NAMES['social_security'] in xlsx.sheet_names:
-            result['social_security'] = self._parse_social_security(xlsx)
+        parsers = {
+            'agents': self._parse_agents,
+            'points': self._parse_points,
+            'social_security': self._parse_social_security,
+            'mapping': self._parse_mapping,
+        }
 
-        # 解析ID映射
-        if self.SHEET_NAMES['mapping'] in xlsx.sheet_names:
-            result['mapping'] = self._parse_mapping(xlsx)
+        # 四个Sheet互相独立，线程池并行解析
+        # calamine在Rust侧解析时释放GIL，线程可真正并行
+        with ThreadPoolExecutor(max_workers=len(parsers)) as pool:
+            futures = {
+                key: pool.submit(self._parse_one_sheet, key, parser, make_source())
+                for key, parser in parsers.items()
+            }
+            for key, future in futures.items():
+                parsed = future.result()
+                if parsed is not None:
+                    result[key] = parsed
 
         # 生成摘要
         result['summary'] = {
@@ -117,6 +168,30 @@ class ExcelParser:
 
         return result
 
+    def _parse_one_sheet(self, key: str, parser, source):
+        """用独立的工作簿句柄解析单个Sheet（供并行调用）"""
+        xlsx = self._open_workbook(source)
+        if self.SHEET_NAMES[key] not in xlsx.sheet_names:
+            return None
+        return parser(xlsx)
+
+    def _open_workbook(self, filepath) -> pd.ExcelFile:
+        """
+        打开Excel文件
+
+        优先使用calamine（Rust实现，解析速度比openpyxl快一个量级，
+        且同时支持xlsx/xls/xlsb）；未安装时退回openpyxl只读模式
+        """
+        try:
+            return pd.ExcelFile(filepath, engine='calamine')
+        except ImportError:
+            # read_only按行流式读取，不构建完整的单元格/样式对象图
+            return pd.ExcelFile(
+                filepath,
+                engine='openpyxl',
+                engine_kwargs={'read_only': True, 'data_only': True}
+            )
+
     def _parse_agents(self, xlsx: pd.ExcelFile) -> List[Dict]:
         """解析经纪人主数据Sheet"""
         df = pd.read_excel(xlsx, sheet_name=self.SHEET_NAMES['agents'])
@@ -138,20 +213,19 @@ class ExcelParser:
             df['join_date'] = pd.to_datetime(df['join_date'], errors='coerce')
             df['join_year'] = df['join_date'].dt.year
 
-        # 处理MD资格指标
+        # 处理MD资格指标：整列等值比较，空值自然判为0
         for year in [2022, 2023, 2024, 2025]:
             col = f'md_qualified_{year}'
             if col in df.columns:
-                df[col] = df[col].apply(lambda x: x == '符合' if pd.notna(x) else False)
+                df[col] = (df[col] == '符合').astype('int8')
 
         # 清除无效行（没有经纪人ID的）
-        df = df.dropna(subset=['agent_id'])
-        df['agent_id'] = df['agent_id'].apply(self._normalize_agent_id)
+        df['agent_id'] = self._normalize_agent_ids(df['agent_id'])
         df = df.dropna(subset=['agent_id'])
 
         return df.to_dict('records')
 
-    def _parse_points(self, xlsx: pd.ExcelFile) -> List[Dict]:
+    def _parse_points(self, xlsx: pd.ExcelFile) -> pd.DataFrame:
         """解析积分数据Sheet"""
         df = pd.read_excel(xlsx, sheet_name=self.SHEET_NAMES['points'])
 
@@ -160,8 +234,8 @@ class ExcelParser:
 
         # 清除无效行（包含注释的行）
         df = df.dropna(subset=['agent_id'])
-        df = df[df['agent_id'].apply(lambda x: not str(x).startswith('注'))]
-        df['agent_id'] = df['agent_id'].apply(self._normalize_agent_id)
+        df = df[~df['agent_id'].astype('string').str.startswith('注', na=False)]
+        df['agent_id'] = self._normalize_agent_ids(df['agent_id'])
         df = df.dropna(subset=['agent_id'])
 
         # 数据清洗
@@ -178,28 +252,18 @@ class ExcelParser:
             df['transaction_time'] = pd.to_datetime(df['transaction_time'], errors='coerce')
             df['transaction_year'] = df['transaction_time'].dt.year
 
-        return df.to_dict('records')
+        # 积分数据只进数据库，保持DataFrame直通save_data，
+        # 不再展开成字典记录（省一份全量拷贝）
+        return df
 
-    def _normalize_agent_id(self, value):
-        """规范化经纪人/销售人员ID为整数"""
-        if pd.isna(value):
-            return None
-        text = str(value).strip()
-        if text == '':
-            return None
-        # 处理类似 12345.0
-        if text.endswith('.0') and text.replace('.0', '').isdigit():
-            return int(text.replace('.0', ''))
-        if text.isdigit():
-            return int(text)
-        # 尝试将浮点数转换为整数
-        try:
-            num = float(text)
-            if num.is_integer():
-                return int(num)
-        except ValueError:
-            return None
-        return None
+    def _normalize_agent_ids(self, ids: pd.Series) -> pd.Series:
+        """整列规范化经纪人/销售人员ID为可空整数
+
+        pd.to_numeric直接识别'12345'和'12345.0'这类字符串，
+        非数字和非整数值置为NA，后续dropna统一清除
+        """
+        numeric = pd.to_numeric(ids, errors='coerce')
+        return numeric.where(numeric % 1 == 0).astype('Int64')
 
     def _parse_social_security(self, xlsx: pd.ExcelFile) -> List[Dict]:
         """解析社保公积金数据Sheet"""
@@ -208,52 +272,48 @@ class ExcelParser:
         # 这个Sheet结构比较复杂，有多层表头
         # 主要提取：姓名、服务年月、社保公积金企业小计
 
-        result = []
-
-        # 跳过表头行，找到数据行
-        # 根据数据特征，第0行是二级表头，第1行开始是数据
-        for idx, row in df.iterrows():
-            # 跳过表头和注释行
-            if pd.isna(row.iloc[0]) or str(row.iloc[0]).startswith('注'):
-                continue
-            if row.iloc[0] == '序号':
-                continue
-
-            try:
-                record = {
-                    'sequence': row.iloc[0],
-                    'bill_name': row.iloc[1],
-                    'name': row.iloc[2],
-                    'unique_id': row.iloc[3],
-                    'id_card': row.iloc[4],
-                    'client_code': row.iloc[5],
-                    'service_month': row.iloc[6],
-                    'company_total': self._safe_float(row.iloc[-3]),  # 社保公积金企业小计
-                    'personal_total': self._safe_float(row.iloc[-2]),  # 社保公积金个人小计
-                    'total': self._safe_float(row.iloc[-1])  # 小计
-                }
-
-                # 从账单名中提取地域信息
-                if pd.notna(record['bill_name']):
-                    record['region'] = self._extract_region(str(record['bill_name']))
-
-                if pd.notna(record['name']) and record['company_total'] > 0:
-                    result.append(record)
-            except (IndexError, ValueError):
-                continue
-
-        return result
+        # 跳过表头和注释行（第0行是二级表头，'注'开头的是注释）
+        # 先转可空string再掩码过滤，空值不参与前缀判断
+        first = df.iloc[:, 0].astype('string')
+        df = df[first.notna()
+                & ~first.str.startswith(('注', '序号'), na=False)]
+
+        # 按列整体切片和转换，不做逐行迭代
+        out = pd.DataFrame({
+            'sequence': df.iloc[:, 0],
+            'bill_name': df.iloc[:, 1],
+            'name': df.iloc[:, 2],
+            'unique_id': df.iloc[:, 3],
+            'id_card': df.iloc[:, 4],
+            'client_code': df.iloc[:, 5],
+            'service_month': df.iloc[:, 6],
+            # 社保公积金企业小计 / 个人小计 / 小计
+            'company_total': pd.to_numeric(df.iloc[:, -3], errors='coerce').fillna(0.0),
+            'personal_total': pd.to_numeric(df.iloc[:, -2], errors='coerce').fillna(0.0),
+            'total': pd.to_numeric(df.iloc[:, -1], errors='coerce').fillna(0.0),
+        })
+
+        out = out[out['name'].notna() & (out['company_total'] > 0)]
+
+        # 从账单名中提取地域信息：整列正则提取，无命中记为'其他'
+        bills = out['bill_name'].astype('string')
+        region = bills.str.extract(f'({self._REGION_RE.pattern})', expand=False)
+        out['region'] = (
+            region.fillna('其他').astype(object).where(bills.notna(), None)
+        )
+
+        return out.to_dict('records')
 
     def _parse_mapping(self, xlsx: pd.ExcelFile) -> Dict[str, int]:
         """解析ID映射Sheet"""
         df = pd.read_excel(xlsx, sheet_name=self.SHEET_NAMES['mapping'])
 
-        mapping = {}
-        for _, row in df.iterrows():
-            if pd.notna(row['经纪人id']) and pd.notna(row['UID']):
-                mapping[str(row['经纪人id'])] = int(row['UID'])
-
-        return mapping
+        # 整列去空后一次性zip成字典，避免逐行迭代
+        sub = df.dropna(subset=['经纪人id', 'UID'])
+        return dict(zip(
+            sub['经纪人id'].astype(str),
+            sub['UID'].astype('int64').tolist()
+        ))
 
     def _safe_float(self, value) -> float:
         """安全转换为浮点数"""
@@ -267,18 +327,11 @@ class ExcelParser:
     def _extract_region(self, bill_name: str) -> str:
         """从账单名称中提取地域信息"""
         # 示例：'保险北京代理江苏' -> 尝试提取省份/城市
-        regions = [
-            '北京', '上海', '广州', '深圳', '天津', '重庆',
-            '江苏', '浙江', '广东', '山东', '河南', '四川',
-            '湖北', '湖南', '河北', '福建', '安徽', '辽宁',
-            '陕西', '江西', '云南', '贵州', '山西', '吉林',
-            '黑龙江', '海南', '甘肃', '青海', '宁夏', '新疆',
-            '西藏', '内蒙古', '广西', '常州', '苏州', '无锡',
-            '南京', '杭州', '宁波', '温州', '成都', '武汉'
-        ]
-
-        for region in regions:
-            if region in bill_name:
-                return region
-
-        return '其他'
+        if self._REGION_AUTOMATON is not None:
+            return next(
+                (region for _, region in self._REGION_AUTOMATON.iter(bill_name)),
+                '其他'
+            )
+
+        match = self._REGION_RE.search(bill_name)
+        return match.group(0) if match else '其他'
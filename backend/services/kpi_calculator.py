@@ -3,10 +3,33 @@ KPI计算引擎
 计算边际贡献、留存率、人效等核心指标
 """
 from typing import Dict, Any, List, Optional
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from operator import itemgetter
+import functools
+import itertools
+import numpy as np
 import pandas as pd
 import os
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+from ._kpi_kernels import year_stats
+
+
+def _margin_expression(fyc, income, points, ss):
+    """边际贡献 = FYC - 个人收入 - 积分 - 社保
+
+    numexpr可用时按缓存大小分块融合求值，四个操作数只过一遍内存、
+    不生成中间临时数组；未安装时退回普通NumPy运算
+    """
+    if numexpr is not None:
+        return numexpr.evaluate('fyc - income - points - ss')
+    return fyc - income - points - ss
+
 
 class KPICalculator:
     """KPI计算器"""
@@ -22,8 +45,120 @@ class KPICalculator:
         'is_peer': 'is_peer'
     }
 
+    # 每类缓存的最大条目数（超过即整体清空，避免无界增长）
+    CACHE_MAX_ENTRIES = 64
+
     def __init__(self, data_store):
         self.data_store = data_store
+        # 请求级缓存：同一份数据上重复的筛选/汇总查询直接复用结果
+        # 键为(数据版本, 业务键)，数据版本变化后旧条目自然失效
+        self._cache = {}
+
+    def _cached(self, kind: str, key: tuple, loader):
+        """按(数据版本, 业务键)缓存loader的结果
+
+        版本号来自data_store，每次save_data递增，
+        因此缓存无需TTL也不会返回过期数据
+        """
+        cache_key = (self.data_store.data_version, kind, key)
+        if cache_key not in self._cache:
+            if len(self._cache) >= self.CACHE_MAX_ENTRIES:
+                self._cache.clear()
+            self._cache[cache_key] = loader()
+        return self._cache[cache_key]
+
+    @staticmethod
+    def _filters_key(filters: Optional[Dict[str, Any]]) -> tuple:
+        """把筛选条件字典转换为可哈希的缓存键"""
+        return tuple(sorted((filters or {}).items()))
+
+    # 数据覆盖的统计年份
+    YEARS = [2022, 2023, 2024, 2025]
+
+    # 年度数值列前缀
+    _METRIC_PREFIXES = ('fyp', 'ape', 'fyc', 'income')
+
+    # 年度数值列名在类加载时拼好，调用路径上不再反复做字符串格式化
+    _METRIC_COLUMNS = [
+        f'{prefix}_{year}'
+        for prefix, year in itertools.product(_METRIC_PREFIXES, YEARS)
+    ]
+
+    def _agents_frame(
+        self,
+        filters: Dict[str, Any] = None,
+        year: int = 2024,
+        extra: tuple = ()
+    ) -> pd.DataFrame:
+        """经纪人的列式(SoA)框架：年度数值列统一为float64、缺失补0
+
+        只向数据层投影KPI实际用到的列（ID+年度指标+分组维度），
+        不物化完整的经纪人字典再二次收集；逐年统计在列向量上
+        做掩码和归约。extra可带上额外的分组列
+        """
+        valid = set(['agent_id'] + self.data_store.AGENT_COLUMNS)
+        group_cols = sorted(
+            (set(self.GROUP_FIELDS.values()) | set(extra)) & valid - {'agent_id'}
+        )
+
+        def build():
+            columns = ['agent_id'] + [
+                col for col in self._METRIC_COLUMNS if col in valid
+            ] + group_cols
+            df = self.data_store.get_agent_frame(filters, year, columns)
+            for col in self._METRIC_COLUMNS:
+                if col in df.columns:
+                    df[col] = pd.to_numeric(
+                        df[col], errors='coerce'
+                    ).fillna(0.0)
+                else:
+                    df[col] = 0.0
+            return df
+
+        return self._cached(
+            'agents_frame',
+            (self._filters_key(filters), year, tuple(group_cols)),
+            build
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def _margin_keys(year: int) -> tuple:
+        """按年份特化的边际贡献列名（每个年份只格式化一次）"""
+        return f'fyc_{year}', f'income_{year}', f'fyp_{year}', f'ape_{year}'
+
+    @staticmethod
+    def _frame_column(frame: pd.DataFrame, col: str) -> np.ndarray:
+        """取指标列向量，数据范围外的年份列返回全0"""
+        if col in frame.columns:
+            return frame[col].to_numpy()
+        return np.zeros(len(frame))
+
+    @staticmethod
+    def _format_group_value(value) -> str:
+        """单个分组值转标签：空值归为'未知'"""
+        if value is None or value != value or not value:
+            return '未知'
+        if isinstance(value, float) and value.is_integer():
+            # 整数列含NULL时会提升为float，还原成整数字符串
+            return str(int(value))
+        return str(value)
+
+    def _group_labels(self, frame: pd.DataFrame, field: str) -> np.ndarray:
+        """分组标签列：空值统一归为'未知'
+
+        分组维度基数很低，先factorize出整数码，
+        标签转换只对每个唯一值做一次，逐行部分只是花式索引
+        """
+        if field not in frame.columns:
+            return np.full(len(frame), '未知', dtype=object)
+
+        codes, uniques = pd.factorize(frame[field], use_na_sentinel=False)
+        mapped = np.array(
+            [self._format_group_value(value) for value in uniques],
+            dtype=object
+        )
+        return mapped[codes]
 
     def calculate_margin_analysis(
         self,
@@ -46,177 +181,195 @@ class KPICalculator:
         Returns:
             分析结果
         """
-        # 获取经纪人数据
-        agents = self.data_store.get_agents(filters, year)
+        # 单维度分组：聚合完全下推到SQL（一条GROUP BY），不逐人回Python累加
+        if not cross_group_by:
+            return self._margin_analysis_sql(filters, group_by, year)
+
+        # 交叉分组仍需逐个经纪人的边际贡献
+        row_field = self.GROUP_FIELDS.get(group_by, group_by)
+        col_field = self.GROUP_FIELDS.get(cross_group_by, cross_group_by)
+        agents_frame = self._agents_frame(
+            filters, year, extra=(row_field, col_field)
+        )
 
-        if not agents:
+        if agents_frame.empty:
             return {'groups': [], 'summary': {}}
 
-        agent_ids = [a['agent_id'] for a in agents]
-
-        # 获取积分数据
-        points_summary = self.data_store.get_points_summary(agent_ids, year)
+        agent_ids = agents_frame['agent_id'].tolist()
 
-        # 获取社保数据
-        ss_summary = self.data_store.get_social_security_summary(agent_ids, year)
+        # 列式(SoA)计算边际贡献：四列float64数组上的ufunc运算
+        fyc_key, income_key, fyp_key, ape_key = self._margin_keys(year)
+        fyc = self._frame_column(agents_frame, fyc_key)
+        income = self._frame_column(agents_frame, income_key)
+        # 积分/社保由数据层按经纪人顺序对齐好，直接参与运算
+        points, ss = self.data_store.get_margin_components(agent_ids, year)
 
-        # 计算每个经纪人的边际贡献
-        for agent in agents:
-            aid = agent['agent_id']
-            fyc = agent.get(f'fyc_{year}', 0) or 0
-            income = agent.get(f'income_{year}', 0) or 0
+        margin = _margin_expression(fyc, income, points, ss)
 
-            # 积分净额（发放 - 扣减）
-            points = points_summary.get(aid, {}).get('net', 0)
+        # 组装列式框架(SoA)，分组统计直接在列上做向量化归约
+        frame = pd.DataFrame({
+            'fyc': fyc,
+            'income': income,
+            'fyp': self._frame_column(agents_frame, fyp_key),
+            'ape': self._frame_column(agents_frame, ape_key),
+            'points': points,
+            'social_security': ss,
+            'margin': margin,
+            # 分类dtype让groupby走整数码的factorization快路径
+            'row': pd.Categorical(self._group_labels(agents_frame, row_field)),
+            'col': pd.Categorical(self._group_labels(agents_frame, col_field)),
+        })
 
-            # 社保公积金企业承担
-            ss = ss_summary.get(aid, 0)
+        result = self._cross_group_analysis(frame)
 
-            # 计算边际贡献
-            margin = fyc - income - points - ss
-            margin_rate = margin / fyc if fyc > 0 else 0
-
-            agent['points'] = points
-            agent['social_security'] = ss
-            agent['margin'] = margin
-            agent['margin_rate'] = margin_rate
-
-        # 分组计算
-        if cross_group_by:
-            result = self._cross_group_analysis(agents, group_by, cross_group_by, year)
-        else:
-            result = self._single_group_analysis(agents, group_by, year)
-
-        # 计算汇总
-        result['summary'] = self._calculate_summary(agents, year)
+        # 汇总直接取自pivot的总计格，无需对全框架再归约一遍
+        result['summary']['year'] = year
 
         return result
 
-    def _single_group_analysis(
+    def _margin_analysis_sql(
         self,
-        agents: List[Dict],
+        filters: Dict[str, Any],
         group_by: str,
         year: int
     ) -> Dict[str, Any]:
-        """单维度分组分析"""
-        groups = defaultdict(list)
+        """单维度分组的边际贡献分析（SQL聚合路径）"""
         field = self.GROUP_FIELDS.get(group_by, group_by)
+        rows = self.data_store.get_margin_by_group(field, filters, year)
 
-        for agent in agents:
-            group_value = agent.get(field, '未知')
-            if group_value is None:
-                group_value = '未知'
-            groups[str(group_value)].append(agent)
-
-        result = []
-        for group_name, group_agents in groups.items():
-            stats = self._calculate_group_stats(group_agents, year)
-            stats['group_name'] = group_name
-            result.append(stats)
+        if not rows:
+            return {'groups': [], 'summary': {}}
 
-        # 按边际贡献率排序
-        result.sort(key=lambda x: x['margin_rate'], reverse=True)
+        # 每行只提取一次：itemgetter一次取全七个值，NULL补0
+        extracted = [
+            tuple(value or 0 for value in self._MARGIN_ROW_GET(row))
+            for row in rows
+        ]
+
+        groups = []
+        for row, values in zip(rows, extracted):
+            stats = self._stats_from_totals(*values)
+            group_value = row['group_name']
+            stats['group_name'] = str(group_value) if group_value is not None else '未知'
+            groups.append(stats)
+
+        # 按边际贡献率排序（itemgetter是C实现，比lambda少一次帧调度）
+        groups.sort(key=itemgetter('margin_rate'), reverse=True)
+
+        # 列转置后逐列求和得到总计
+        summary = self._stats_from_totals(
+            *(sum(column) for column in zip(*extracted))
+        )
+        summary['year'] = year
 
-        return {'groups': result}
+        return {'groups': groups, 'summary': summary}
 
-    def _cross_group_analysis(
+    def _stats_from_totals(
         self,
-        agents: List[Dict],
-        row_by: str,
-        col_by: str,
-        year: int
+        count: int,
+        total_fyc: float,
+        total_income: float,
+        total_fyp: float,
+        total_ape: float,
+        total_points: float,
+        total_ss: float
     ) -> Dict[str, Any]:
-        """交叉分组分析"""
-        row_field = self.GROUP_FIELDS.get(row_by, row_by)
-        col_field = self.GROUP_FIELDS.get(col_by, col_by)
+        """由合计值构建分组统计字典（与_calculate_group_stats同构）"""
+        total_margin = total_fyc - total_income - total_points - total_ss
 
-        # 构建交叉表
-        cross_data = defaultdict(lambda: defaultdict(list))
+        return {
+            'agent_count': count,
+            'total_fyc': round(total_fyc, 2),
+            'total_income': round(total_income, 2),
+            'total_points': round(total_points, 2),
+            'total_social_security': round(total_ss, 2),
+            'total_margin': round(total_margin, 2),
+            'margin_rate': round(total_margin / total_fyc, 4) if total_fyc > 0 else 0,
+            'avg_fyp': round(total_fyp / count, 2) if count else 0,
+            'avg_ape': round(total_ape / count, 2) if count else 0,
+            'avg_fyc': round(total_fyc / count, 2) if count else 0,
+            'avg_margin': round(total_margin / count, 2) if count else 0
+        }
 
-        for agent in agents:
-            row_value = str(agent.get(row_field, '未知') or '未知')
-            col_value = str(agent.get(col_field, '未知') or '未知')
-            cross_data[row_value][col_value].append(agent)
+    # 分组统计涉及的数值列
+    _VALUE_COLUMNS = ['fyc', 'income', 'fyp', 'ape', 'points', 'social_security']
+
+    # SQL聚合行的批量取值器（与_stats_from_totals参数顺序一致）
+    _MARGIN_ROW_GET = itemgetter(
+        'agent_count', 'total_fyc', 'total_income', 'total_fyp',
+        'total_ape', 'total_points', 'total_social_security'
+    )
+
+    def _cross_group_analysis(self, frame: pd.DataFrame) -> Dict[str, Any]:
+        """交叉分组分析（输入为带row/col标签列的列式框架）"""
+        # 单元格和行合计由一次pivot_table算完：
+        # margins=True复用同一份factorization顺带产出'合计'
+        counted = frame[['row', 'col'] + self._VALUE_COLUMNS].copy()
+        counted['agent_count'] = 1
+        pivot = counted.pivot_table(
+            index='row', columns='col',
+            values=['agent_count'] + self._VALUE_COLUMNS,
+            aggfunc='sum', margins=True, margins_name='合计',
+            fill_value=0, observed=True
+        )
+
+        # 摊平成(row, col)为索引的合计表，派生统计整列算、整列round，
+        # 不再逐格调Python的round；空格子在此处被滤掉
+        flat = pivot.stack(level=1)
+        observed = flat[flat['agent_count'] > 0]
+        cell_stats = self._stats_frame(observed).to_dict('index')
 
-        # 计算每个单元格的统计值
-        rows = sorted(cross_data.keys())
-        cols = set()
-        for row_data in cross_data.values():
-            cols.update(row_data.keys())
-        cols = sorted(cols)
+        rows = [row for row in pivot.index if row != '合计']
+        cols = [col for col in pivot['agent_count'].columns if col != '合计']
 
         matrix = []
         for row in rows:
             row_result = {'row_name': row, 'cells': []}
-            for col in cols:
-                cell_agents = cross_data[row].get(col, [])
-                if cell_agents:
-                    stats = self._calculate_group_stats(cell_agents, year)
+            for col in cols + ['合计']:
+                stats = cell_stats.get((row, col))
+                if stats is not None:
                     stats['col_name'] = col
                 else:
                     stats = {'col_name': col, 'agent_count': 0, 'margin_rate': 0}
                 row_result['cells'].append(stats)
-
-            # 行合计
-            row_all = cross_data[row]
-            all_agents = []
-            for col_agents in row_all.values():
-                all_agents.extend(col_agents)
-            row_total = self._calculate_group_stats(all_agents, year)
-            row_total['col_name'] = '合计'
-            row_result['cells'].append(row_total)
             matrix.append(row_result)
 
         return {
             'columns': cols + ['合计'],
-            'matrix': matrix
+            'matrix': matrix,
+            # margins=True顺带产出的总计格就是全表汇总
+            'summary': cell_stats[('合计', '合计')]
         }
 
-    def _calculate_group_stats(self, agents: List[Dict], year: int) -> Dict[str, Any]:
-        """计算分组统计值"""
-        count = len(agents)
-        if count == 0:
-            return {
-                'agent_count': 0,
-                'total_fyc': 0,
-                'total_income': 0,
-                'total_points': 0,
-                'total_social_security': 0,
-                'total_margin': 0,
-                'margin_rate': 0,
-                'avg_fyp': 0,
-                'avg_ape': 0,
-                'avg_fyc': 0,
-                'avg_margin': 0
-            }
-
-        total_fyc = sum(a.get(f'fyc_{year}', 0) or 0 for a in agents)
-        total_income = sum(a.get(f'income_{year}', 0) or 0 for a in agents)
-        total_fyp = sum(a.get(f'fyp_{year}', 0) or 0 for a in agents)
-        total_ape = sum(a.get(f'ape_{year}', 0) or 0 for a in agents)
-        total_points = sum(a.get('points', 0) for a in agents)
-        total_ss = sum(a.get('social_security', 0) for a in agents)
-        total_margin = sum(a.get('margin', 0) for a in agents)
+    def _stats_frame(self, totals: pd.DataFrame) -> pd.DataFrame:
+        """由合计列批量派生分组统计列（与_stats_from_totals同构）
 
-        return {
-            'agent_count': count,
-            'total_fyc': round(total_fyc, 2),
-            'total_income': round(total_income, 2),
-            'total_points': round(total_points, 2),
-            'total_social_security': round(total_ss, 2),
-            'total_margin': round(total_margin, 2),
-            'margin_rate': round(total_margin / total_fyc, 4) if total_fyc > 0 else 0,
-            'avg_fyp': round(total_fyp / count, 2),
-            'avg_ape': round(total_ape / count, 2),
-            'avg_fyc': round(total_fyc / count, 2),
-            'avg_margin': round(total_margin / count, 2)
-        }
+        所有格子的派生值和round在整列上一次完成
+        """
+        count = totals['agent_count']
+        margin = (
+            totals['fyc'] - totals['income']
+            - totals['points'] - totals['social_security']
+        )
+        stats = pd.DataFrame({
+            'agent_count': count.astype(int),
+            'total_fyc': totals['fyc'],
+            'total_income': totals['income'],
+            'total_points': totals['points'],
+            'total_social_security': totals['social_security'],
+            'total_margin': margin,
+            'margin_rate': (margin / totals['fyc']).where(totals['fyc'] > 0, 0),
+            'avg_fyp': totals['fyp'] / count,
+            'avg_ape': totals['ape'] / count,
+            'avg_fyc': totals['fyc'] / count,
+            'avg_margin': margin / count,
+        }, index=totals.index)
+        return stats.round({
+            'total_fyc': 2, 'total_income': 2, 'total_points': 2,
+            'total_social_security': 2, 'total_margin': 2, 'margin_rate': 4,
+            'avg_fyp': 2, 'avg_ape': 2, 'avg_fyc': 2, 'avg_margin': 2
+        })
 
-    def _calculate_summary(self, agents: List[Dict], year: int) -> Dict[str, Any]:
-        """计算汇总统计"""
-        stats = self._calculate_group_stats(agents, year)
-        stats['year'] = year
-        return stats
 
     def calculate_retention_analysis(
         self,
@@ -236,22 +389,33 @@ class KPICalculator:
             留存分析结果
         """
         # 获取所有经纪人数据（不限年份筛选）
-        agents = self.data_store.get_agents(filters)
+        field = self.GROUP_FIELDS.get(group_by, group_by)
+        frame = self._agents_frame(filters, extra=(field,))
 
-        if not agents:
+        if frame.empty:
             return {'groups': [], 'retention_data': []}
 
-        field = self.GROUP_FIELDS.get(group_by, group_by)
+        # N×年份的FYP矩阵：队列统计在列向量上做掩码归约
+        fyp_matrix = np.column_stack([
+            frame[f'fyp_{year}'].to_numpy() for year in self.YEARS
+        ])
+        join_years = pd.to_numeric(
+            frame['join_year'], errors='coerce'
+        ).fillna(0).to_numpy() if 'join_year' in frame.columns else np.zeros(
+            len(frame)
+        )
 
-        # 按分组维度组织数据
-        groups = defaultdict(list)
-        for agent in agents:
-            group_value = str(agent.get(field, '未知') or '未知')
-            groups[group_value].append(agent)
+        # 分组保持首次出现顺序
+        group_indices = {}
+        for i, label in enumerate(self._group_labels(frame, field)):
+            group_indices.setdefault(label, []).append(i)
 
         result = []
-        for group_name, group_agents in groups.items():
-            retention = self._calculate_group_retention(group_agents)
+        for group_name, indices in group_indices.items():
+            idx = np.array(indices)
+            retention = self._calculate_group_retention(
+                fyp_matrix[idx], join_years[idx]
+            )
             result.append({
                 'group_name': group_name,
                 'retention': retention
@@ -262,19 +426,22 @@ class KPICalculator:
             'years_after_join': list(range(1, 5))  # 第1-4年
         }
 
-    def _calculate_group_retention(self, agents: List[Dict]) -> List[Dict]:
-        """计算分组的留存率"""
-        # 按入职年份分组
-        by_join_year = defaultdict(list)
-        for agent in agents:
-            join_year = agent.get('join_year')
+    def _calculate_group_retention(
+        self,
+        fyp_matrix: np.ndarray,
+        join_years: np.ndarray
+    ) -> List[Dict]:
+        """计算分组的留存率（输入为N×年份的FYP矩阵和入职年份向量）"""
+        # 按入职年份分队列，保持首次出现顺序
+        cohorts = {}
+        for i, join_year in enumerate(join_years.tolist()):
             if join_year:
-                by_join_year[join_year].append(agent)
+                cohorts.setdefault(int(join_year), []).append(i)
 
         retention_data = []
-        years = [2022, 2023, 2024, 2025]
+        years = self.YEARS
 
-        for join_year, cohort in by_join_year.items():
+        for join_year, rows in cohorts.items():
             # 使用最早的数据年份作为基准
             # 如果入职年份在数据范围内，使用入职年份；否则使用第一个数据年份
             if join_year >= years[0]:
@@ -282,15 +449,21 @@ class KPICalculator:
             else:
                 base_year = years[0]
 
-            base_col = f'fyp_{base_year}'
+            # 基准年不在数据范围内时没有基准出单人，整个队列跳过
+            if base_year not in years:
+                continue
+
+            cohort = fyp_matrix[np.array(rows)]
+            base_values = cohort[:, years.index(base_year)]
             # 基准年的出单人
-            base_active = [a for a in cohort if (a.get(base_col, 0) or 0) > 0]
-            base_count = len(base_active)
-            base_fyp = sum(a.get(base_col, 0) or 0 for a in base_active)
+            base_active = base_values > 0
+            base_count = int(base_active.sum())
 
             if base_count == 0:
                 continue
 
+            base_fyp = float(base_values[base_active].sum())
+
             cohort_retention = {
                 'join_year': join_year,
                 'base_year': base_year,  # 添加实际基准年
@@ -299,17 +472,16 @@ class KPICalculator:
                 'years': []
             }
 
-            # 计算各年的留存
-            for year in years:
+            # 计算各年的留存：基准出单人掩码与当年出单掩码按位与
+            for col, year in enumerate(years):
                 years_after = year - base_year  # 相对于基准年的年数
                 if years_after < 0:
                     continue
 
-                fyp_col = f'fyp_{year}'
-                # 计算基准年出单人在当年的留存
-                current_active = [a for a in base_active if (a.get(fyp_col, 0) or 0) > 0]
-                current_count = len(current_active)
-                current_fyp = sum(a.get(fyp_col, 0) or 0 for a in current_active)
+                values = cohort[:, col]
+                current_mask = base_active & (values > 0)
+                current_count = int(current_mask.sum())
+                current_fyp = float(values[current_mask].sum())
 
                 cohort_retention['years'].append({
                     'year': year,
@@ -341,31 +513,39 @@ class KPICalculator:
         Returns:
             人效走势数据
         """
-        agents = self.data_store.get_agents(filters)
+        field = self.GROUP_FIELDS.get(group_by, group_by)
+        frame = self._agents_frame(filters, extra=(field,))
 
-        if not agents:
+        if frame.empty:
             return {'groups': [], 'years': []}
 
-        field = self.GROUP_FIELDS.get(group_by, group_by)
+        years = self.YEARS
 
-        # 按分组维度组织数据
-        groups = defaultdict(list)
-        for agent in agents:
-            group_value = str(agent.get(field, '未知') or '未知')
-            groups[group_value].append(agent)
+        # 逐年的出单掩码和指标值整列取出
+        fyp_arrays = {
+            year: frame[f'fyp_{year}'].to_numpy() for year in years
+        }
+        value_arrays = self._metric_arrays(frame, metric, years)
+
+        # 分组标签factorize成整数码（保持首次出现顺序），
+        # 每年一次内核调用算出所有分组的出单人数和指标合计
+        codes, group_names = pd.factorize(self._group_labels(frame, field))
+        n_groups = len(group_names)
+        year_totals = {
+            year: year_stats(
+                fyp_arrays[year], value_arrays[year], codes, n_groups
+            )
+            for year in years
+        }
 
-        years = [2022, 2023, 2024, 2025]
         result = []
-
-        for group_name, group_agents in groups.items():
+        for group_pos, group_name in enumerate(group_names):
             trend = []
             prev_value = None
 
             for year in years:
-                # 计算当年出单人
-                fyp_col = f'fyp_{year}'
-                active_agents = [a for a in group_agents if (a.get(fyp_col, 0) or 0) > 0]
-                count = len(active_agents)
+                counts, totals = year_totals[year]
+                count = int(counts[group_pos])
 
                 if count == 0:
                     trend.append({
@@ -376,22 +556,7 @@ class KPICalculator:
                     })
                     continue
 
-                # 计算指标值
-                if metric == 'avg_fyp':
-                    total = sum(a.get(fyp_col, 0) or 0 for a in active_agents)
-                elif metric == 'avg_ape':
-                    ape_col = f'ape_{year}'
-                    total = sum(a.get(ape_col, 0) or 0 for a in active_agents)
-                elif metric == 'avg_fyc':
-                    fyc_col = f'fyc_{year}'
-                    total = sum(a.get(fyc_col, 0) or 0 for a in active_agents)
-                elif metric == 'avg_margin':
-                    # 需要计算边际贡献
-                    total = self._calculate_total_margin(active_agents, year)
-                else:
-                    total = sum(a.get(fyp_col, 0) or 0 for a in active_agents)
-
-                avg_value = total / count
+                avg_value = float(totals[group_pos]) / count
 
                 # 计算同比
                 yoy_change = None
@@ -418,24 +583,75 @@ class KPICalculator:
             'metric': metric
         }
 
-    def _calculate_total_margin(self, agents: List[Dict], year: int) -> float:
-        """计算总边际贡献"""
-        agent_ids = [a['agent_id'] for a in agents]
-        points_summary = self.data_store.get_points_summary(agent_ids, year)
-        ss_summary = self.data_store.get_social_security_summary(agent_ids, year)
+    def _metric_arrays(
+        self,
+        frame: pd.DataFrame,
+        metric: str,
+        years: List[int]
+    ) -> Dict[int, np.ndarray]:
+        """按年份取指标列向量（avg_margin为四列向量化合成）"""
+        if metric == 'avg_margin':
+            agent_ids = frame['agent_id'].tolist()
+            arrays = {}
+            for year in years:
+                points, ss = self.data_store.get_margin_components(
+                    agent_ids, year
+                )
+                arrays[year] = _margin_expression(
+                    frame[f'fyc_{year}'].to_numpy(),
+                    frame[f'income_{year}'].to_numpy(),
+                    points, ss
+                )
+            return arrays
+
+        prefix = {'avg_ape': 'ape', 'avg_fyc': 'fyc'}.get(metric, 'fyp')
+        return {
+            year: frame[f'{prefix}_{year}'].to_numpy() for year in years
+        }
 
-        total_margin = 0
-        for agent in agents:
-            aid = agent['agent_id']
-            fyc = agent.get(f'fyc_{year}', 0) or 0
-            income = agent.get(f'income_{year}', 0) or 0
-            points = points_summary.get(aid, {}).get('net', 0)
-            ss = ss_summary.get(aid, 0)
+    def calculate_all(
+        self,
+        filters: Dict[str, Any] = None,
+        group_by: str = 'region',
+        year: int = 2024,
+        metric: str = 'avg_fyp'
+    ) -> Dict[str, Any]:
+        """
+        并行计算面板用到的全部KPI
+
+        三个分析互不共享可变状态，pandas/NumPy的归约在C层释放GIL，
+        线程池能真正并行；共享的经纪人框架先预热进缓存，
+        各线程直接复用同一份列式数据
 
-            margin = fyc - income - points - ss
-            total_margin += margin
+        Args:
+            filters: 筛选条件
+            group_by: 分组维度
+            year: 统计年份（边际贡献分析用）
+            metric: 人效指标类型
 
-        return total_margin
+        Returns:
+            {'margin': ..., 'retention': ..., 'efficiency': ...}
+        """
+        field = self.GROUP_FIELDS.get(group_by, group_by)
+        self._agents_frame(filters, extra=(field,))
+
+        tasks = {
+            'margin': lambda: self.calculate_margin_analysis(
+                filters, group_by, year=year
+            ),
+            'retention': lambda: self.calculate_retention_analysis(
+                filters, group_by
+            ),
+            'efficiency': lambda: self.calculate_efficiency_trend(
+                filters, group_by, metric
+            ),
+        }
+
+        with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+            futures = {
+                key: pool.submit(task) for key, task in tasks.items()
+            }
+            return {key: future.result() for key, future in futures.items()}
 
     def export_to_excel(
         self,
@@ -457,7 +673,7 @@ class KPICalculator:
         )
         os.makedirs(export_dir, exist_ok=True)
 
-        filename = f'{export_type}_{pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+        filename = f'{export_type}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
         filepath = os.path.join(export_dir, filename)
 
         filters = params.get('filters', {})
@@ -502,5 +718,11 @@ class KPICalculator:
         else:
             raise ValueError(f'未知的导出类型: {export_type}')
 
-        df.to_excel(filepath, index=False)
+        # xlsxwriter按行流式写出，constant_memory避免整个工作簿驻留内存
+        with pd.ExcelWriter(
+            filepath,
+            engine='xlsxwriter',
+            engine_kwargs={'options': {'constant_memory': True}}
+        ) as writer:
+            df.to_excel(writer, index=False)
         return filepath
@@ -29,7 +29,7 @@ export const healthCheck = async (): Promise<boolean> => {
   }
 };
 
-// 上传Excel文件
+// 上传Excel文件（后端异步处理，轮询任务状态直到完成）
 export const uploadFile = async (file: File): Promise<UploadResult> => {
   const formData = new FormData();
   formData.append('file', file);
@@ -39,7 +39,25 @@ export const uploadFile = async (file: File): Promise<UploadResult> => {
       'Content-Type': 'multipart/form-data',
     },
   });
-  return response.data;
+
+  const jobId: string = response.data.job_id;
+  if (!jobId) {
+    // 兼容同步返回结果的旧后端
+    return response.data;
+  }
+
+  for (;;) {
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    const status = await api.get(`/upload-status/${jobId}`);
+    if (status.data.status === 'done') {
+      return status.data;
+    }
+    if (status.data.status === 'error') {
+      const err: any = new Error(status.data.error);
+      err.response = { data: { error: status.data.error } };
+      throw err;
+    }
+  }
 };
 
 // 获取筛选器选项